@@ -0,0 +1,75 @@
+/*
+ * containers.cpp
+ *
+ * Copyright (C) 2023 Mateusz Stadnik <matgla@live.com>
+ *
+ * This program is free software: you can redistribute it and/or
+ * modify it under the terms of the GNU General Public License
+ * as published by the Free Software Foundation, either version
+ * 3 of the License, or (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be
+ * useful, but WITHOUT ANY WARRANTY; without even the implied
+ * warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+ * PURPOSE. See the GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General
+ * Public License along with this program. If not, see
+ * <https://www.gnu.org/licenses/>.
+ */
+
+#include <algorithm>
+#include <cstdio>
+#include <map>
+#include <string>
+#include <vector>
+
+namespace
+{
+
+struct Entry
+{
+  std::string name;
+  int priority;
+};
+
+std::vector<Entry> create_entries()
+{
+  std::vector<Entry> entries;
+  entries.push_back({"scheduler", 3});
+  entries.push_back({"filesystem", 1});
+  entries.push_back({"network", 2});
+  entries.push_back({"console", 5});
+  entries.push_back({"timer", 4});
+  return entries;
+}
+
+} // namespace
+
+int main()
+{
+  std::vector<Entry> entries = create_entries();
+  std::sort(entries.begin(), entries.end(),
+            [](const Entry &a, const Entry &b) {
+              return a.priority < b.priority;
+            });
+
+  std::map<std::string, int> index;
+  for (const Entry &entry : entries)
+  {
+    index[entry.name] = entry.priority;
+  }
+
+  std::string joined;
+  for (const auto &item : index)
+  {
+    if (!joined.empty())
+    {
+      joined += ",";
+    }
+    joined += item.first;
+  }
+
+  std::printf("%s\n", joined.c_str());
+  return static_cast<int>(index.size());
+}
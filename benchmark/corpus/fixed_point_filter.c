@@ -0,0 +1,82 @@
+/*
+ * fixed_point_filter.c
+ *
+ * Copyright (C) 2023 Mateusz Stadnik <matgla@live.com>
+ *
+ * This program is free software: you can redistribute it and/or
+ * modify it under the terms of the GNU General Public License
+ * as published by the Free Software Foundation, either version
+ * 3 of the License, or (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be
+ * useful, but WITHOUT ANY WARRANTY; without even the implied
+ * warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+ * PURPOSE. See the GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General
+ * Public License along with this program. If not, see
+ * <https://www.gnu.org/licenses/>.
+ */
+
+#include <stdint.h>
+#include <string.h>
+
+#define TAPS 16
+#define SAMPLES 64
+
+static const int16_t coefficients[TAPS] = {
+  -12, -31, -18, 64, 212, 401, 560, 624, 624, 560, 401, 212, 64, -18, -31, -12,
+};
+
+static int16_t history[TAPS];
+static int16_t input[SAMPLES];
+static int16_t output[SAMPLES];
+static uint32_t seed = 0x12345678;
+
+static int16_t next_sample(void)
+{
+  seed = seed * 1664525u + 1013904223u;
+  return (int16_t)(seed >> 16);
+}
+
+static int16_t saturate(int32_t value)
+{
+  if (value > INT16_MAX)
+  {
+    return INT16_MAX;
+  }
+  if (value < INT16_MIN)
+  {
+    return INT16_MIN;
+  }
+  return (int16_t)value;
+}
+
+static int16_t filter(int16_t sample)
+{
+  memmove(&history[1], &history[0], (TAPS - 1) * sizeof(history[0]));
+  history[0] = sample;
+
+  int32_t accumulator = 0;
+  for (int i = 0; i < TAPS; ++i)
+  {
+    accumulator += (int32_t)history[i] * coefficients[i];
+  }
+  return saturate(accumulator >> 12);
+}
+
+int main(void)
+{
+  for (int i = 0; i < SAMPLES; ++i)
+  {
+    input[i] = next_sample();
+  }
+
+  int32_t energy = 0;
+  for (int i = 0; i < SAMPLES; ++i)
+  {
+    output[i] = filter(input[i]);
+    energy += output[i] >> 4;
+  }
+  return energy & 0xff;
+}
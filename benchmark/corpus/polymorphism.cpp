@@ -0,0 +1,92 @@
+/*
+ * polymorphism.cpp
+ *
+ * Copyright (C) 2023 Mateusz Stadnik <matgla@live.com>
+ *
+ * This program is free software: you can redistribute it and/or
+ * modify it under the terms of the GNU General Public License
+ * as published by the Free Software Foundation, either version
+ * 3 of the License, or (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be
+ * useful, but WITHOUT ANY WARRANTY; without even the implied
+ * warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+ * PURPOSE. See the GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General
+ * Public License along with this program. If not, see
+ * <https://www.gnu.org/licenses/>.
+ */
+
+#include <array>
+#include <cstdint>
+#include <cstdio>
+
+namespace
+{
+
+class Shape
+{
+public:
+  virtual ~Shape() = default;
+  virtual int32_t area() const = 0;
+  virtual const char *name() const = 0;
+};
+
+template <int32_t Width, int32_t Height>
+class Rectangle : public Shape
+{
+public:
+  int32_t area() const override
+  {
+    return Width * Height;
+  }
+
+  const char *name() const override
+  {
+    return "rectangle";
+  }
+};
+
+template <int32_t Radius>
+class Circle : public Shape
+{
+public:
+  int32_t area() const override
+  {
+    return (Radius * Radius * 355) / 113;
+  }
+
+  const char *name() const override
+  {
+    return "circle";
+  }
+};
+
+template <typename... Shapes>
+int32_t total_area(const Shapes &...shapes)
+{
+  return (shapes.area() + ...);
+}
+
+Rectangle<3, 4> small_rectangle;
+Rectangle<10, 20> big_rectangle;
+Circle<5> small_circle;
+
+} // namespace
+
+int main()
+{
+  std::array<const Shape *, 3> shapes = {
+    &small_rectangle,
+    &big_rectangle,
+    &small_circle,
+  };
+
+  for (const Shape *shape : shapes)
+  {
+    std::printf("%s: %ld\n", shape->name(), static_cast<long>(shape->area()));
+  }
+
+  return total_area(small_rectangle, big_rectangle, small_circle) & 0xff;
+}
@@ -0,0 +1,114 @@
+/*
+ * state_machine.c
+ *
+ * Copyright (C) 2023 Mateusz Stadnik <matgla@live.com>
+ *
+ * This program is free software: you can redistribute it and/or
+ * modify it under the terms of the GNU General Public License
+ * as published by the Free Software Foundation, either version
+ * 3 of the License, or (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be
+ * useful, but WITHOUT ANY WARRANTY; without even the implied
+ * warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+ * PURPOSE. See the GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General
+ * Public License along with this program. If not, see
+ * <https://www.gnu.org/licenses/>.
+ */
+
+#include <stdio.h>
+
+typedef enum
+{
+  State_Idle,
+  State_Running,
+  State_Paused,
+  State_Stopped,
+  State_Count
+} State;
+
+typedef enum
+{
+  Event_Start,
+  Event_Pause,
+  Event_Resume,
+  Event_Stop,
+  Event_Count
+} Event;
+
+typedef State (*Handler)(Event event);
+
+static int transitions;
+
+static State on_idle(Event event)
+{
+  return event == Event_Start ? State_Running : State_Idle;
+}
+
+static State on_running(Event event)
+{
+  switch (event)
+  {
+    case Event_Pause:
+      return State_Paused;
+    case Event_Stop:
+      return State_Stopped;
+    default:
+      return State_Running;
+  }
+}
+
+static State on_paused(Event event)
+{
+  switch (event)
+  {
+    case Event_Resume:
+      return State_Running;
+    case Event_Stop:
+      return State_Stopped;
+    default:
+      return State_Paused;
+  }
+}
+
+static State on_stopped(Event event)
+{
+  (void)event;
+  return State_Stopped;
+}
+
+static const Handler handlers[State_Count] = {
+  on_idle,
+  on_running,
+  on_paused,
+  on_stopped,
+};
+
+static const char *state_names[State_Count] = {
+  "idle",
+  "running",
+  "paused",
+  "stopped",
+};
+
+static const Event script[] = {
+  Event_Start, Event_Pause, Event_Resume, Event_Pause, Event_Stop,
+};
+
+int main(void)
+{
+  State state = State_Idle;
+  for (unsigned i = 0; i < sizeof(script) / sizeof(script[0]); ++i)
+  {
+    State next = handlers[state](script[i]);
+    if (next != state)
+    {
+      ++transitions;
+      printf("%s -> %s\n", state_names[state], state_names[next]);
+    }
+    state = next;
+  }
+  return transitions;
+}
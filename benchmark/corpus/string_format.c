@@ -0,0 +1,64 @@
+/*
+ * string_format.c
+ *
+ * Copyright (C) 2023 Mateusz Stadnik <matgla@live.com>
+ *
+ * This program is free software: you can redistribute it and/or
+ * modify it under the terms of the GNU General Public License
+ * as published by the Free Software Foundation, either version
+ * 3 of the License, or (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be
+ * useful, but WITHOUT ANY WARRANTY; without even the implied
+ * warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+ * PURPOSE. See the GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General
+ * Public License along with this program. If not, see
+ * <https://www.gnu.org/licenses/>.
+ */
+
+#include <ctype.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+static char buffer[128];
+static const char *names[] = {"alpha", "beta", "gamma", "delta", "epsilon"};
+static int counter = 3;
+
+static void to_upper(char *text)
+{
+  while (*text)
+  {
+    *text = toupper((unsigned char)*text);
+    ++text;
+  }
+}
+
+static int parse_number(const char *text)
+{
+  char *end;
+  long value = strtol(text, &end, 10);
+  if (*end != '\0')
+  {
+    return -1;
+  }
+  return (int)value;
+}
+
+int main(void)
+{
+  for (int i = 0; i < (int)(sizeof(names) / sizeof(names[0])); ++i)
+  {
+    snprintf(buffer, sizeof(buffer), "%s:%d", names[i], counter + i);
+    to_upper(buffer);
+    puts(buffer);
+  }
+
+  char *copy = strdup("12345");
+  int value = parse_number(copy);
+  free(copy);
+  printf("value: %d, length: %u\n", value, (unsigned)strlen(buffer));
+  return value == 12345 ? 0 : 1;
+}
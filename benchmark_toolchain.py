@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# benchmark_toolchain.py
+#
+# Copyright (C) 2023 Mateusz Stadnik <matgla@live.com>
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General
+# Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+from pathlib import Path
+import argparse
+import json
+import subprocess
+import time
+
+corpus_directory = Path(__file__).parent / "benchmark" / "corpus"
+
+module_flags = [
+    "-Os",
+    "-ffunction-sections",
+    "-fdata-sections",
+    "-msingle-pic-base",
+    "-mno-pic-data-is-text-relative",
+    "-fPIC",
+]
+
+cxx_flags = ["-std=c++17"]
+
+libc_variants = {
+    "nano": {"link": ["--specs=nano.specs"], "cxx": ["-fno-exceptions"]},
+    "full": {"link": [], "cxx": []},
+}
+
+# Modules are not executed, so unresolved syscalls are fine, the point is to
+# get final layout of sections including GOT
+link_flags = [
+    "-nostartfiles",
+    "-Wl,--gc-sections",
+    "-Wl,--entry=main",
+    "-Wl,--unresolved-symbols=ignore-all",
+]
+
+size_metrics = ["text", "data", "got"]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(__file__),
+        description="Measure compile throughput and module sizes for Yasld Toolchain",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "-p",
+        "--prefix",
+        default="build/yasld-toolchain",
+        help="Installed toolchain to benchmark",
+    )
+    parser.add_argument(
+        "-t",
+        "--target",
+        default="arm-none-eabi",
+        help="Toolchain target triple",
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        default="build/benchmark",
+        help="Directory for objects and results",
+    )
+    parser.add_argument(
+        "-b",
+        "--baseline",
+        default=str(Path(__file__).parent / "benchmark" / "baseline.json"),
+        help="Results to compare with",
+    )
+    parser.add_argument(
+        "-u",
+        "--update-baseline",
+        default=False,
+        action="store_true",
+        help="Store results as new baseline",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=3,
+        help="Number of compilations of each module, the fastest one is used",
+    )
+    parser.add_argument(
+        "--size-threshold",
+        type=float,
+        default=1.0,
+        help="Allowed growth of section size in percents",
+    )
+    parser.add_argument(
+        "--time-threshold",
+        type=float,
+        default=10.0,
+        help="Growth of compilation time in percents that is reported, \
+            compilation time never fails the comparison",
+    )
+
+    args, _ = parser.parse_known_args()
+    return args
+
+
+def get_corpus():
+    return sorted(
+        [
+            path
+            for path in corpus_directory.iterdir()
+            if path.suffix in (".c", ".cpp")
+        ]
+    )
+
+
+def get_driver(prefix, target, source):
+    if source.suffix == ".cpp":
+        return str(Path(prefix) / "bin" / (target + "-g++"))
+    return str(Path(prefix) / "bin" / (target + "-gcc"))
+
+
+def get_multilibs(prefix, target):
+    result = subprocess.run(
+        [str(Path(prefix) / "bin" / (target + "-gcc")), "-print-multi-lib"],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0
+    return parse_multilibs(result.stdout)
+
+
+def parse_multilibs(output):
+    multilibs = []
+    for line in output.split("\n"):
+        if len(line.strip()) == 0:
+            continue
+        directory, flags = line.strip().split(";", 1)
+        multilibs.append(
+            (
+                directory,
+                ["-" + flag for flag in flags.split("@") if len(flag) != 0],
+            )
+        )
+    return multilibs
+
+
+def get_compile_flags(source, multilib_flags, libc):
+    flags = module_flags + multilib_flags
+    if source.suffix == ".cpp":
+        flags = flags + cxx_flags + libc_variants[libc]["cxx"]
+    return flags
+
+
+def get_preprocessed_lines(driver, source, flags):
+    result = subprocess.run(
+        [driver, "-E", str(source)] + flags,
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0
+    return result.stdout.count("\n")
+
+
+def compile_module(driver, source, flags, output, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(
+            [driver, "-c", str(source), "-o", str(output)] + flags
+        )
+        elapsed = time.perf_counter() - start
+        assert result.returncode == 0
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def get_section_sizes(prefix, target, elf):
+    result = subprocess.run(
+        [str(Path(prefix) / "bin" / (target + "-size")), "-A", str(elf)],
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0
+
+    sizes = {metric: 0 for metric in size_metrics}
+    for line in result.stdout.split("\n"):
+        fields = line.split()
+        if len(fields) != 3 or not fields[0].startswith("."):
+            continue
+        for metric in size_metrics:
+            if fields[0].startswith("." + metric):
+                sizes[metric] += int(fields[1])
+    return sizes
+
+
+def benchmark(prefix, target, output_directory, repeat):
+    results = {}
+    for multilib, multilib_flags in get_multilibs(prefix, target):
+        for libc in libc_variants.keys():
+            directory = Path(output_directory) / multilib / libc
+            directory.mkdir(parents=True, exist_ok=True)
+            for source in get_corpus():
+                print(
+                    " - Benchmarking {} for multilib '{}' with {} libc".format(
+                        source.name, multilib, libc
+                    )
+                )
+                driver = get_driver(prefix, target, source)
+                flags = get_compile_flags(source, multilib_flags, libc)
+                obj = directory / (source.stem + ".o")
+                elf = directory / (source.stem + ".elf")
+
+                compile_time = compile_module(
+                    driver, source, flags, obj, repeat
+                )
+                lines = get_preprocessed_lines(driver, source, flags)
+
+                result = subprocess.run(
+                    [driver, str(obj), "-o", str(elf)]
+                    + flags
+                    + link_flags
+                    + libc_variants[libc]["link"]
+                )
+                assert result.returncode == 0
+
+                entry = {
+                    "compile_time": compile_time,
+                    "lines_per_second": lines / compile_time,
+                }
+                entry.update(get_section_sizes(prefix, target, elf))
+                results["{}|{}|{}".format(source.name, multilib, libc)] = entry
+    return results
+
+
+def compare(results, baseline, size_threshold, time_threshold):
+    regressions = []
+    for key, entry in sorted(results.items()):
+        if key not in baseline:
+            print(" - {}: not in baseline".format(key))
+            continue
+        reference = baseline[key]
+        for metric in size_metrics + ["compile_time"]:
+            if metric not in reference:
+                continue
+            threshold = size_threshold
+            if metric == "compile_time":
+                threshold = time_threshold
+            if reference[metric] == 0:
+                growth = 0 if entry[metric] == 0 else 100.0
+            else:
+                growth = (
+                    (entry[metric] - reference[metric])
+                    * 100.0
+                    / reference[metric]
+                )
+            if growth <= threshold:
+                continue
+            # Milliseconds of small modules, possibly measured on other
+            # machine, are too noisy to fail on
+            if metric == "compile_time":
+                print(
+                    " - SLOWER {} {}: {:.4f}s -> {:.4f}s ({:+.1f}%)".format(
+                        key, metric, reference[metric], entry[metric], growth
+                    )
+                )
+                continue
+            regressions.append((key, metric, reference[metric], entry[metric]))
+            print(
+                " - REGRESSION {} {}: {} -> {} ({:+.1f}%)".format(
+                    key, metric, reference[metric], entry[metric], growth
+                )
+            )
+    return regressions
+
+
+def print_summary(results):
+    totals = {}
+    for key, entry in results.items():
+        _, multilib, libc = key.split("|")
+        total = totals.setdefault(
+            (multilib, libc), {metric: 0 for metric in size_metrics + ["time"]}
+        )
+        total["time"] += entry["compile_time"]
+        for metric in size_metrics:
+            total[metric] += entry[metric]
+
+    print(
+        "  {:<30} {:<5} {:>9} {:>8} {:>8} {:>8}".format(
+            "multilib", "libc", "time[s]", "text", "data", "got"
+        )
+    )
+    for (multilib, libc), total in sorted(totals.items()):
+        print(
+            "  {:<30} {:<5} {:>9.3f} {:>8} {:>8} {:>8}".format(
+                multilib,
+                libc,
+                total["time"],
+                total["text"],
+                total["data"],
+                total["got"],
+            )
+        )
+
+
+def run(
+    prefix,
+    target,
+    output_directory,
+    baseline,
+    update_baseline,
+    repeat=3,
+    size_threshold=1.0,
+    time_threshold=10.0,
+):
+    results = benchmark(prefix, target, output_directory, repeat)
+    print_summary(results)
+
+    with open(Path(output_directory) / "results.json", "w") as file:
+        json.dump(results, file, indent=2, sort_keys=True)
+
+    if update_baseline:
+        print(" - Storing baseline:", baseline)
+        with open(baseline, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+        return 0
+
+    if not os.path.exists(baseline):
+        print(" - Baseline not found:", baseline)
+        return 0
+
+    with open(baseline, "r") as file:
+        reference = json.load(file)
+
+    if len(compare(results, reference, size_threshold, time_threshold)) != 0:
+        return 1
+    print(" - No regressions against:", baseline)
+    return 0
+
+
+def main():
+    args = parse_arguments()
+    sys.exit(
+        run(
+            args.prefix,
+            args.target,
+            args.output_dir,
+            args.baseline,
+            args.update_baseline,
+            args.repeat,
+            args.size_threshold,
+            args.time_threshold,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+
+#
+# build_planner.py
+#
+# Copyright (C) 2023 Mateusz Stadnik <matgla@live.com>
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General
+# Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+# Plans build of component/variant graph using durations recorded by
+# previous builds. Nodes are (component, variant) tuples, the same jobs that
+# build_toolchain schedules, shared stages are done by the first started
+# variant of a component and so is the build of a tree shared by variants.
+
+import heapq
+import os
+import statistics
+
+from components.timings import stages, shared_stages
+
+history_length = 5
+
+# Stages running parallel make, duration scales with cores given to a job
+parallel_stages = ["compile", "install"]
+
+# Stages done once for a build tree shared by variants, see binutils
+tree_stages = ["configure", "compile"]
+
+# Core budgets shown in plan, i.e. to size CI runners
+core_budgets = [2, 4, 8, 16, 32, 64]
+
+# Stage is reported when it got slower by both ratio and absolute time
+regression_ratio = 1.25
+regression_seconds = 30
+
+
+def create_graph(components, dependencies, variants):
+    graph = {}
+
+    def add(component, variant):
+        node = (component, variant)
+        if node in graph:
+            return
+        graph[node] = []
+        for dependency in dependencies.get(component, []):
+            add(dependency, variant)
+            graph[node].append((dependency, variant))
+
+    for variant in variants:
+        for component in components:
+            add(component, variant)
+    return graph
+
+
+def estimate_stage(timings, component, variants, stage, cores=None):
+    # variants is a build key, list of keys sharing a tree or None for all
+    if isinstance(variants, str):
+        variants = [variants]
+    entries = [
+        t
+        for t in timings
+        if t["component"] == component
+        and t["stage"] == stage
+        and (variants is None or t["variant"] in variants)
+    ]
+    if len(entries) == 0:
+        return None
+    durations = []
+    for t in entries[-history_length:]:
+        duration = t["duration"]
+        if cores is not None and stage in parallel_stages and t.get("cpus"):
+            duration = duration * t["cpus"] / cores
+        durations.append(duration)
+    if stage in shared_stages or (variants is not None and len(variants) > 1):
+        # Only first variant does the work, others find it done
+        return max(durations)
+    return statistics.median(durations)
+
+
+def estimate_node(timings, node, key, cores=None, node_stages=None):
+    component, _ = node
+    if node_stages is None:
+        node_stages = [stage for stage in stages if stage not in shared_stages]
+    cost = 0
+    known = True
+    for stage in node_stages:
+        duration = estimate_stage(timings, component, key, stage, cores)
+        if duration is None:
+            # New variant of known component costs about the same
+            duration = estimate_stage(timings, component, None, stage, cores)
+        if duration is None:
+            known = False
+            continue
+        cost += duration
+    return cost, known
+
+
+def estimate_sources(timings, component):
+    cost = 0
+    known = True
+    for stage in shared_stages:
+        duration = estimate_stage(timings, component, None, stage)
+        if duration is None:
+            known = False
+            continue
+        cost += duration
+    return cost, known
+
+
+def get_resources(graph, trees={}):
+    # Work done by the first started node while others wait for it: sources
+    # of a component and build trees shared by variants, i.e. binutils
+    nodes = {}
+    for node in graph:
+        nodes.setdefault(trees.get(node, node), []).append(node)
+    resources = {}
+    for node in graph:
+        resources[node] = [("sources", node[0])]
+        tree = trees.get(node, node)
+        if len(nodes[tree]) > 1:
+            resources[node].append(("tree",) + tuple(tree))
+    return resources
+
+
+def estimate_costs(timings, graph, done, keys={}, cores=None, resources=None):
+    # keys map nodes to build keys used in timings, i.e. with build profile,
+    # cores are given to each job, None keeps recorded durations
+    if resources is None:
+        resources = get_resources(graph)
+    tree_keys = {}
+    for node in graph:
+        for resource in resources[node]:
+            if resource[0] == "tree":
+                tree_keys.setdefault(resource, []).append(
+                    keys.get(node, node[1])
+                )
+    costs = {}
+    shared = {}
+    unknown = []
+    for node in graph:
+        component = node[0]
+        if node in done:
+            costs[node] = 0
+            for resource in resources[node]:
+                shared.setdefault(resource, 0)
+            continue
+        node_stages = [stage for stage in stages if stage not in shared_stages]
+        known = True
+        for resource in resources[node]:
+            if resource[0] == "sources":
+                shared[resource], resource_known = estimate_sources(
+                    timings, component
+                )
+            else:
+                # Shared tree is configured and compiled once, every variant
+                # installs it into own prefix
+                shared[resource], resource_known = estimate_node(
+                    timings, node, tree_keys[resource], cores, tree_stages
+                )
+                node_stages = [
+                    stage for stage in node_stages if stage not in tree_stages
+                ]
+            known = known and resource_known
+        costs[node], node_known = estimate_node(
+            timings, node, keys.get(node, node[1]), cores, node_stages
+        )
+        if not known or not node_known:
+            unknown.append(node)
+    return costs, shared, unknown
+
+
+def get_dependents(graph):
+    dependents = {node: [] for node in graph}
+    for node, dependencies in graph.items():
+        for dependency in dependencies:
+            dependents[dependency].append(node)
+    return dependents
+
+
+def get_ranks(graph, costs, shared={}, resources=None):
+    # Longest path from node to the end of build, node with the highest rank
+    # is the long pole and should be started first
+    if resources is None:
+        resources = get_resources(graph)
+    dependents = get_dependents(graph)
+    ranks = {}
+
+    def rank(node):
+        if node not in ranks:
+            ranks[node] = (
+                costs[node]
+                + sum(shared.get(resource, 0) for resource in resources[node])
+                + max(
+                    [rank(dependent) for dependent in dependents[node]],
+                    default=0,
+                )
+            )
+        return ranks[node]
+
+    for node in graph:
+        rank(node)
+    return ranks
+
+
+def get_critical_path(graph, costs, ranks):
+    dependents = get_dependents(graph)
+    roots = [
+        node for node, dependencies in graph.items() if len(dependencies) == 0
+    ]
+    if len(roots) == 0:
+        return []
+    path = [max(roots, key=lambda node: ranks[node])]
+    while len(dependents[path[-1]]) != 0:
+        path.append(max(dependents[path[-1]], key=lambda node: ranks[node]))
+    return path
+
+
+def simulate(graph, costs, shared, resources, ranks, jobs):
+    # Mirrors process_components: jobs start by rank when dependencies are
+    # finished, the first started node does shared work, i.e. fetches sources
+    # or compiles binutils tree, while others wait for its lock
+    remaining = {
+        node: len(dependencies) for node, dependencies in graph.items()
+    }
+    dependents = get_dependents(graph)
+    ready = [
+        (-ranks[node], node) for node, count in remaining.items() if count == 0
+    ]
+    heapq.heapify(ready)
+    running = []
+    shared_ready = {}
+    now = 0
+    while len(ready) != 0 or len(running) != 0:
+        while len(ready) != 0 and len(running) < jobs:
+            _, node = heapq.heappop(ready)
+            start = now
+            for resource in resources[node]:
+                if resource not in shared_ready:
+                    shared_ready[resource] = start + shared.get(resource, 0)
+                start = max(start, shared_ready[resource])
+            heapq.heappush(running, (start + costs[node], node))
+        now, node = heapq.heappop(running)
+        for dependent in dependents[node]:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                heapq.heappush(ready, (-ranks[dependent], dependent))
+    return now
+
+
+def predict(timings, graph, done, keys, trees, cores, max_jobs):
+    # Scheduler splits cores between jobs, so the best number of concurrent
+    # jobs depends on the budget
+    resources = get_resources(graph, trees)
+    best = None
+    for jobs in range(1, min(max_jobs, cores) + 1):
+        costs, shared, _ = estimate_costs(
+            timings, graph, done, keys, cores // jobs, resources
+        )
+        ranks = get_ranks(graph, costs, shared, resources)
+        duration = simulate(graph, costs, shared, resources, ranks, jobs)
+        if best is None or duration < best[0]:
+            best = (duration, jobs)
+    return best
+
+
+def find_regressions(timings):
+    history = {}
+    for t in timings:
+        key = (t["component"], t["variant"], t["stage"])
+        history.setdefault(key, []).append(t["duration"])
+
+    regressions = []
+    for key, durations in sorted(history.items()):
+        if len(durations) < 2:
+            continue
+        previous = statistics.median(durations[-history_length - 1 : -1])
+        latest = durations[-1]
+        if (
+            latest > previous * regression_ratio
+            and latest - previous > regression_seconds
+        ):
+            regressions.append((key, previous, latest))
+    return regressions
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}h{:02d}m{:02d}s".format(hours, minutes, seconds)
+
+
+def format_node(node):
+    component, variant = node
+    return "{} [{}]".format(
+        component, variant if len(variant) != 0 else "default"
+    )
+
+
+def format_resource(resource):
+    if resource[0] == "sources":
+        return "{} (sources)".format(resource[1])
+    return "{} (shared tree)".format(format_node(resource[1:]))
+
+
+def print_plan(timings, graph, done, keys, trees, max_jobs):
+    cpus = os.cpu_count() or 1
+    resources = get_resources(graph, trees)
+    costs, shared, unknown = estimate_costs(
+        timings, graph, done, keys, cpus, resources
+    )
+    ranks = get_ranks(graph, costs, shared, resources)
+
+    print("Estimated stages with {} cores:".format(cpus))
+    for resource, cost in sorted(shared.items()):
+        if cost != 0:
+            print(
+                "  {:>10}  {}".format(
+                    format_duration(cost), format_resource(resource)
+                )
+            )
+    for node in sorted(graph, key=lambda node: ranks[node], reverse=True):
+        state = ""
+        if node in done:
+            state = " (done)"
+        elif node in unknown:
+            state = " (no history)"
+        print(
+            "  {:>10}  {}{}".format(
+                format_duration(costs[node]), format_node(node), state
+            )
+        )
+
+    path = get_critical_path(graph, costs, ranks)
+    path_resources = set(
+        resource for node in path for resource in resources[node]
+    )
+    print()
+    print(
+        "Critical path: {}".format(
+            format_duration(
+                sum(costs[node] for node in path)
+                + sum(shared[resource] for resource in path_resources)
+            )
+        )
+    )
+    for node in path:
+        print(
+            "  {:>10}  {}".format(
+                format_duration(costs[node]), format_node(node)
+            )
+        )
+
+    print()
+    print("Predicted wall time per core budget:")
+    for cores in sorted(set(core_budgets + [cpus])):
+        duration, jobs = predict(
+            timings, graph, done, keys, trees, cores, max_jobs
+        )
+        print(
+            "  {:>3} cores: {} ({} jobs of {} cores){}".format(
+                cores,
+                format_duration(duration),
+                jobs,
+                cores // jobs,
+                " <- this machine" if cores == cpus else "",
+            )
+        )
+
+    regressions = find_regressions(timings)
+    if len(regressions) != 0:
+        print()
+        print("Regressed stages:")
+        for (component, variant, stage), previous, latest in regressions:
+            print(
+                "  {} {}: {} -> {}".format(
+                    format_node((component, variant)),
+                    stage,
+                    format_duration(previous),
+                    format_duration(latest),
+                )
+            )
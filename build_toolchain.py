@@ -29,8 +29,27 @@ import importlib
 import importlib.util
 import subprocess
 import glob
+import itertools
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from sys import platform
 
+import benchmark_toolchain
+import build_planner
+import compile_profiler
+from components.target_flags import (
+    default_target,
+    default_flag_profile,
+    flag_profiles,
+    get_variant_name,
+)
+from components.timings import load_timings
+from components.recipe_base import (
+    default_build_profile,
+    get_build_key,
+    select_build_profile,
+)
+
 def parse_arguments():
     parser = argparse.ArgumentParser(
         prog=os.path.basename(__file__),
@@ -73,6 +92,117 @@ def parse_arguments():
         action="store_true",
         help="Scripts components verification, i.e. for building from master"
     )
+    parser.add_argument(
+        "-t",
+        "--targets",
+        default=default_target,
+        help="Targets to build toolchain for, list with ',' delimiter",
+    )
+    parser.add_argument(
+        "-f",
+        "--flag-profiles",
+        default=default_flag_profile,
+        help="Target libraries flag profiles, list with ',' delimiter, \
+            available: " + ", ".join(flag_profiles.keys()),
+    )
+    parser.add_argument(
+        "--build-profile",
+        default=default_build_profile,
+        help="Build profile, 'minimal' prunes subprojects not used by Yasld. \
+            Name applies to all components, '<component>=<profile>' to one, \
+            list with ',' delimiter",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=0,
+        help="Number of components built concurrently, 0 for one job per \
+            target/flag profile variant",
+    )
+    parser.add_argument(
+        "--plan",
+        default=False,
+        action="store_true",
+        help="Show critical path and predicted build time based on timings \
+            of previous builds",
+    )
+    parser.add_argument(
+        "-p",
+        "--compile-profile",
+        nargs="?",
+        const="",
+        default=None,
+        help="Record time of each compilation in given database, \
+            <build-dir>/compile_profile.db if path not provided",
+    )
+    parser.add_argument(
+        "--compile-report",
+        type=int,
+        default=20,
+        help="Number of the most expensive files shown in compile profile report",
+    )
+    parser.add_argument(
+        "--optimized-compiler",
+        default=False,
+        action="store_true",
+        help="Build gcc with profile guided optimization and LTO, trained \
+            on benchmark corpus",
+    )
+    parser.add_argument(
+        "--shard-multilibs",
+        default=False,
+        action="store_true",
+        help="Configure and build newlib for each multilib as independent job, \
+            gcc target libraries (libgcc, libstdc++) are not sharded",
+    )
+    parser.add_argument(
+        "--benchmark",
+        default=False,
+        action="store_true",
+        help="Measure compile throughput and module sizes of built toolchain \
+            and compare them with stored baseline",
+    )
+    parser.add_argument(
+        "--update-baseline",
+        default=False,
+        action="store_true",
+        help="Store benchmark results as new baseline",
+    )
+    parser.add_argument(
+        "--no-strip",
+        default=False,
+        action="store_true",
+        help="Install host tools with debug information",
+    )
+    parser.add_argument(
+        "--package",
+        default=None,
+        metavar="VERSION",
+        help="Create release archive with sha256 manifest for given version",
+    )
+    parser.add_argument(
+        "--previous-release",
+        default=None,
+        help="Previous release archive or prefix, binary delta against it is \
+            created together with package",
+    )
+    parser.add_argument(
+        "-r",
+        "--ramdisk",
+        nargs="?",
+        const="/dev/shm",
+        default=None,
+        help="Extract sources and build on tmpfs under given path, \
+            only installation, downloads and stamps are kept in build directory",
+    )
+    parser.add_argument(
+        "--ramdisk-reserve",
+        type=int,
+        default=2048,
+        help="Memory in MiB that must stay free when component is built on \
+            ramdisk, otherwise component is built on disk",
+    )
 
     args, _ = parser.parse_known_args()
     return args
@@ -114,14 +244,123 @@ def filter_components(components, allowed_components):
     return [value for value in components if value in allowed_components]
 
 
-def print_options(components, args):
+def get_variants(targets, profiles):
+    variants = []
+    for target, profile in itertools.product(
+        targets.split(","), profiles.split(",")
+    ):
+        if profile not in flag_profiles:
+            print(" - ERROR, unknown flag profile:", profile)
+            sys.exit(-1)
+        variants.append(
+            {
+                "name": get_variant_name(target, profile),
+                "target": target,
+                "flag_profile": profile,
+            }
+        )
+    return variants
+
+
+def get_variant_prefix(output_directory, variant):
+    name = "yasld-toolchain"
+    if len(variant["name"]) != 0:
+        name += "-" + variant["name"]
+    return (Path(output_directory) / name).resolve()
+
+
+def print_options(components, variants, args):
     print(" - build directory:  ", args.build_dir)
     print(" - output directory: ", args.output_dir)
     print(" - components:       ", components)
+    print(" - build profile:    ", args.build_profile)
+    print(
+        " - variants:         ",
+        [variant["target"] + ":" + variant["flag_profile"] for variant in variants],
+    )
+    if args.ramdisk is not None:
+        print(" - ramdisk:          ", args.ramdisk)
+    if args.compile_profile is not None:
+        print(" - compile profile:  ", args.compile_profile)
+    if args.optimized_compiler:
+        print(" - optimized compiler: PGO + LTO")
+    if args.shard_multilibs:
+        print(" - sharded multilibs: newlib only")
+
+
+def parse_build_profiles(value):
+    # 'minimal' or 'minimal,binutils=full', name without component is for all
+    profiles = {}
+    for entry in value.split(","):
+        if "=" in entry:
+            component, profile = entry.split("=", 1)
+            profiles[component.strip()] = profile.strip()
+        else:
+            profiles["*"] = entry.strip()
+    return profiles
+
+
+def check_build_profiles(components, build_profiles):
+    # Global profile falls back to full for recipes without it, so it must be
+    # known to at least one of them, otherwise it is a typo
+    available = {}
+    for component in get_dependencies(components):
+        recipe = load_recipe(component, components_directory / (component + ".py"))
+        available[component] = getattr(
+            recipe, "build_profiles", {default_build_profile: {}}
+        )
+
+    errors = []
+    for component, profile in build_profiles.items():
+        if component == "*":
+            if not any(profile in profiles for profiles in available.values()):
+                errors.append("unknown build profile: '{}'".format(profile))
+        elif component not in available:
+            errors.append("build profile for unknown component: '{}'".format(component))
+        elif profile not in available[component]:
+            errors.append(
+                "unknown build profile for '{}': '{}'".format(component, profile)
+            )
+    for error in errors:
+        print(" - ERROR,", error)
+    return len(errors) == 0
+
 
+def get_component_profile(recipe, component, build_profiles):
+    return select_build_profile(
+        build_profiles,
+        component,
+        getattr(recipe, "build_profiles", {default_build_profile: {}}),
+    )
+
+
+def get_component_key(component, variant, build_profiles, options=None):
+    recipe = load_recipe(component, components_directory / (component + ".py"))
+    profile = get_component_profile(recipe, component, build_profiles)
+    mode = ""
+    if hasattr(recipe, "get_build_mode") and options is not None:
+        mode = recipe.get_build_mode(options)
+    return get_build_key(variant, profile, mode)
+
+
+def get_done_flag(output_directory, component, key):
+    if len(key) != 0:
+        component += "-" + key
+    return Path(output_directory) / (component + "_done")
 
-def build_component(component, output_directory, prefix, skip_verification):
-    if os.path.exists(Path(output_directory) / (component + "_done")):
+
+def build_component(component, output_directory, prefix, skip_verification, **options):
+    done_flag_file = get_done_flag(
+        output_directory,
+        component,
+        get_component_key(
+            component,
+            options.get("variant", ""),
+            options.get("build_profiles"),
+            options,
+        ),
+    )
+    if os.path.exists(done_flag_file):
         return
 
     recipe = load_recipe(component, components_directory / (component + ".py"))
@@ -135,32 +374,210 @@ def build_component(component, output_directory, prefix, skip_verification):
     else:
         if hasattr(recipe, "dependencies"):
             for dependency in recipe.dependencies:
-                build_component(dependency, output_directory, prefix, skip_verification)
+                build_component(
+                    dependency, output_directory, prefix, skip_verification, **options
+                )
 
-        recipe.get_recipe(output_directory, prefix, skip_verification).build()
+        recipe.get_recipe(
+            output_directory, prefix, skip_verification, **options
+        ).build()
         # If finished everything was built correctly
-        (Path(output_directory) / (component + "_done")).touch()
+        done_flag_file.touch()
+
+
+def get_dependencies(components):
+    dependencies = {}
+    pending = list(components)
+    while len(pending) != 0:
+        component = pending.pop()
+        if component in dependencies:
+            continue
+        recipe = load_recipe(component, components_directory / (component + ".py"))
+        dependencies[component] = list(getattr(recipe, "dependencies", []))
+        pending.extend(dependencies[component])
+    return dependencies
+
+
+def get_build_keys(graph, build_profiles, options=None):
+    return {
+        node: get_component_key(node[0], node[1], build_profiles, options)
+        for node in graph
+    }
+
+
+def get_tree_keys(graph, variants, build_profiles):
+    # Recipes with get_tree_key build variants of the same tree once, i.e.
+    # binutils share one tree per target
+    targets = {variant["name"]: variant["target"] for variant in variants}
+    trees = {}
+    for component, variant in graph:
+        recipe = load_recipe(
+            component, components_directory / (component + ".py")
+        )
+        if hasattr(recipe, "get_tree_key"):
+            profile = get_component_profile(recipe, component, build_profiles)
+            trees[(component, variant)] = (
+                component,
+                recipe.get_tree_key(targets[variant], profile),
+            )
+    return trees
 
 
-def process_components(components, output_directory, skip_verification):
-    prefix = (Path(output_directory) / "yasld-toolchain").resolve()
-    for component in components:
-        build_component(component, output_directory, prefix, skip_verification)
+def get_done_nodes(output_directory, graph, keys):
+    return set(
+        node
+        for node in graph
+        if get_done_flag(output_directory, node[0], keys[node]).exists()
+    )
+
 
+def create_plan(
+    components, output_directory, variants, build_profiles, options=None
+):
+    graph = build_planner.create_graph(
+        components,
+        get_dependencies(components),
+        [variant["name"] for variant in variants],
+    )
+    timings = load_timings(output_directory)
+    keys = get_build_keys(graph, build_profiles, options)
+    trees = get_tree_keys(graph, variants, build_profiles)
+    done = get_done_nodes(output_directory, graph, keys)
+    return graph, timings, done, keys, trees
+
+
+def show_plan(
+    components, output_directory, variants, build_profiles, options=None
+):
+    graph, timings, done, keys, trees = create_plan(
+        components, output_directory, variants, build_profiles, options
+    )
+    # Any node may run concurrently, predict picks the best number of jobs
+    build_planner.print_plan(
+        timings, graph, done, keys, trees, max(len(graph), 1)
+    )
 
-def strip_toolchain(output_directory):
-    if platform == "darwin":
-        cmd = "find " + str(output_directory) + "/bin -type f -and \\( -perm +111 \\) -exec strip '{}' \\;"
-    else: 
-        cmd = "find " + str(output_directory) + "/bin -type f -and \\( -executable \\) -exec strip '{}' \\;"
 
-    print("Stripping with command: ", cmd)
-    result = subprocess.run(
-        cmd,
-        shell=True,
+def process_components(
+    components, output_directory, skip_verification, variants, jobs, **options
+):
+    if jobs <= 0:
+        jobs = len(variants)
+    # Every job runs make, so cores are split to not oversubscribe host
+    options["make_jobs"] = max(1, (os.cpu_count() or 1) // jobs)
+
+    graph, timings, done, keys, trees = create_plan(
+        components,
+        output_directory,
+        variants,
+        options.get("build_profiles"),
+        options,
     )
+    resources = build_planner.get_resources(graph, trees)
+    costs, shared, _ = build_planner.estimate_costs(
+        timings, graph, done, keys, options["make_jobs"], resources
+    )
+    ranks = build_planner.get_ranks(graph, costs, shared, resources)
+    variants_by_name = {variant["name"]: variant for variant in variants}
+
+    # Shared stages are done by the first variant that builds the component
+    pending = set(node for node in graph if node not in done)
+    finished = set(node for node in graph if node in done)
+    running = {}
+
+    # Long pole jobs, i.e. gcc, are started first
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while len(pending) != 0 or len(running) != 0:
+            ready = [
+                node
+                for node in pending
+                if all(dependency in finished for dependency in graph[node])
+            ]
+            ready.sort(key=lambda node: ranks[node], reverse=True)
+            for node in ready[: jobs - len(running)]:
+                component, name = node
+                variant = variants_by_name[name]
+                pending.remove(node)
+                print(" - Starting:", build_planner.format_node(node))
+                running[
+                    executor.submit(
+                        build_component,
+                        component,
+                        output_directory,
+                        get_variant_prefix(output_directory, variant),
+                        skip_verification,
+                        target=variant["target"],
+                        flag_profile=variant["flag_profile"],
+                        variant=variant["name"],
+                        **options
+                    )
+                ] = node
+
+            completed, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for build in completed:
+                build.result()
+                finished.add(running.pop(build))
+
+
+def benchmark_variants(output_directory, variants, update_baseline):
+    failed = False
+    for variant in variants:
+        baseline = "baseline.json"
+        if len(variant["name"]) != 0:
+            baseline = "baseline-" + variant["name"] + ".json"
+        name = variant["name"] if len(variant["name"]) != 0 else "default"
+        result = benchmark_toolchain.run(
+            get_variant_prefix(output_directory, variant),
+            variant["target"],
+            Path(output_directory) / "benchmark" / name,
+            Path(__file__).parent / "benchmark" / baseline,
+            update_baseline,
+        )
+        failed = failed or result != 0
+    return not failed
+
+
+def package_variants(output_directory, variants, version, previous_release):
+    # bsdiff4 is needed only for releases, not for regular builds
+    import toolchain_delta
+
+    release_directory = Path(output_directory) / "release"
+    for variant in variants:
+        prefix = get_variant_prefix(output_directory, variant)
+        archive = toolchain_delta.package(
+            prefix, version, release_directory, prefix.name
+        )
+
+        if previous_release is not None:
+            with tempfile.TemporaryDirectory() as directory:
+                previous_prefix = toolchain_delta.open_release(
+                    previous_release, directory
+                )
+                previous_version = toolchain_delta.read_manifest(previous_prefix)[
+                    "version"
+                ]
+                delta = release_directory / "{}-{}-to-{}.delta.tar.xz".format(
+                    prefix.name, previous_version, version
+                )
+                print(" - Creating delta:", delta)
+                toolchain_delta.create_delta(previous_prefix, prefix, delta)
+        print(" - Release package:", archive)
+
+
+def strip_toolchain(output_directory, strip=True):
+    if strip:
+        if platform == "darwin":
+            cmd = "find " + str(output_directory) + "/bin -type f -and \\( -perm +111 \\) -exec strip '{}' \\;"
+        else: 
+            cmd = "find " + str(output_directory) + "/bin -type f -and \\( -executable \\) -exec strip '{}' \\;"
+
+        print("Stripping with command: ", cmd)
+        result = subprocess.run(
+            cmd,
+            shell=True,
+        )
 
-    assert result.returncode == 0
+        assert result.returncode == 0
 
     print("Removing {prefix}/lib/libcc1.*".format(prefix=output_directory))
     files = glob.glob("{prefix}/lib/libcc1*".format(prefix=output_directory))
@@ -179,12 +596,65 @@ def main():
     if args.components != "all":
         components = filter_components(components, args.components)
 
-    print_options(components, args)
+    variants = get_variants(args.targets, args.flag_profiles)
+    if args.compile_profile == "":
+        args.compile_profile = str(Path(args.build_dir) / "compile_profile.db")
+
+    build_profiles = parse_build_profiles(args.build_profile)
+    if not check_build_profiles(components, build_profiles):
+        sys.exit(-1)
+    if args.optimized_compiler and "gcc" in get_dependencies(components):
+        gcc = load_recipe("gcc", components_directory / "gcc.py")
+        error = gcc.check_optimized_compiler()
+        if error is not None:
+            print(" - ERROR,", error)
+            sys.exit(-1)
+    if args.previous_release is not None and len(variants) != 1:
+        print(" - ERROR, --previous-release can be used with single variant only")
+        sys.exit(-1)
+
+    if args.plan:
+        show_plan(
+            components,
+            args.build_dir,
+            variants,
+            build_profiles,
+            {"optimized_compiler": args.optimized_compiler},
+        )
+        sys.exit(0)
+
+    print_options(components, variants, args)
     (Path(args.build_dir) / "sources" / "download").mkdir(
         parents=True, exist_ok=True
     )
-    process_components(components, args.build_dir, args.no_verify)
-    strip_toolchain(Path(args.build_dir) / "yasld-toolchain")
+    process_components(
+        components,
+        args.build_dir,
+        args.no_verify,
+        variants,
+        args.jobs,
+        ramdisk=args.ramdisk,
+        ramdisk_reserve=args.ramdisk_reserve,
+        compile_profile=args.compile_profile,
+        optimized_compiler=args.optimized_compiler,
+        shard_multilibs=args.shard_multilibs,
+        build_profiles=build_profiles,
+        strip=not args.no_strip,
+    )
+    for variant in variants:
+        strip_toolchain(get_variant_prefix(args.build_dir, variant), not args.no_strip)
+
+    if args.compile_profile is not None:
+        compile_profiler.report(args.compile_profile, args.compile_report)
+
+    if args.package is not None:
+        package_variants(
+            args.build_dir, variants, args.package, args.previous_release
+        )
+
+    if args.benchmark or args.update_baseline:
+        if not benchmark_variants(args.build_dir, variants, args.update_baseline):
+            sys.exit(1)
 
 
 if __name__ == "__main__":
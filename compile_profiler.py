@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# compile_profiler.py
+#
+# Copyright (C) 2023 Mateusz Stadnik <matgla@live.com>
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General
+# Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+# Compiler wrapper recording per translation unit compilation cost.
+# Recipes inject it with CC, CXX and CC_FOR_TARGET:
+#   compile_profiler.py exec --database <db> --component <name> \
+#       --variant <build key> --tree <build tree> --kind <host|target> \
+#       -- <compiler> <args>
+
+import os
+import sys
+import argparse
+import bisect
+import sqlite3
+import subprocess
+import time
+from sys import platform
+
+source_extensions = (".c", ".cc", ".cpp", ".cxx", ".c++", ".C", ".S", ".s")
+
+# Options selecting multilib variant of target libraries
+multilib_options = (
+    "-mthumb",
+    "-marm",
+    "-march=",
+    "-mcpu=",
+    "-mfloat-abi=",
+    "-mfpu=",
+    "-mbig-endian",
+    "-mlittle-endian",
+    "-mbranch-protection=",
+)
+
+# Options with value in next argument, not interesting as flags
+ignored_options_with_value = ("-o", "-MF", "-MT", "-MQ")
+ignored_options = ("-MD", "-MMD", "-MP")
+
+schema = """
+CREATE TABLE IF NOT EXISTS flags (
+    id INTEGER PRIMARY KEY,
+    value TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS compilations (
+    component TEXT NOT NULL,
+    variant TEXT NOT NULL DEFAULT '',
+    tree TEXT NOT NULL DEFAULT '',
+    kind TEXT NOT NULL,
+    source TEXT NOT NULL,
+    object TEXT,
+    multilib TEXT NOT NULL,
+    flags INTEGER NOT NULL REFERENCES flags(id),
+    start REAL NOT NULL,
+    wall REAL NOT NULL,
+    cpu REAL NOT NULL,
+    rss INTEGER NOT NULL,
+    returncode INTEGER NOT NULL
+);
+"""
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(__file__),
+        description="Profile compilation of Yasld Toolchain",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    exec_parser = subparsers.add_parser(
+        "exec", help="Run and record compiler invocation"
+    )
+    exec_parser.add_argument("--database", required=True)
+    exec_parser.add_argument("--component", required=True)
+    exec_parser.add_argument("--variant", default="")
+    exec_parser.add_argument("--tree", default="")
+    exec_parser.add_argument("--kind", default="host")
+    exec_parser.add_argument("compiler", nargs=argparse.REMAINDER)
+
+    report_parser = subparsers.add_parser(
+        "report", help="Show summary of recorded compilations"
+    )
+    report_parser.add_argument("--database", required=True)
+    report_parser.add_argument(
+        "-n",
+        "--top",
+        type=int,
+        default=20,
+        help="Number of the most expensive files to show",
+    )
+    report_parser.add_argument(
+        "--component", default=None, help="Show only given component"
+    )
+
+    return parser.parse_args()
+
+
+def open_database(path):
+    connection = sqlite3.connect(str(path), timeout=60)
+    connection.executescript(schema)
+    # Databases from older builds lack variant and tree
+    columns = [
+        row[1] for row in connection.execute("PRAGMA table_info(compilations)")
+    ]
+    for column in ["variant", "tree"]:
+        if column not in columns:
+            connection.execute(
+                "ALTER TABLE compilations ADD COLUMN {} TEXT NOT NULL DEFAULT ''".format(
+                    column
+                )
+            )
+    return connection
+
+
+def get_sources(args):
+    return [
+        arg
+        for arg in args
+        if not arg.startswith("-") and arg.endswith(source_extensions)
+    ]
+
+
+def get_object(args):
+    if "-o" in args:
+        index = args.index("-o")
+        if index + 1 < len(args):
+            return args[index + 1]
+    return None
+
+
+def get_multilib(args, kind):
+    if kind == "host":
+        return "host"
+    options = []
+    for arg in args:
+        if arg.startswith(multilib_options) and arg not in options:
+            options.append(arg)
+    if len(options) == 0:
+        return "default"
+    return " ".join(options)
+
+
+def get_flags(args, sources):
+    flags = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+            continue
+        if arg in ignored_options_with_value:
+            skip = True
+            continue
+        if arg in ignored_options or arg in sources:
+            continue
+        flags.append(arg)
+    return " ".join(flags)
+
+
+def is_translation_unit(args, sources):
+    if len(sources) != 1:
+        return False
+    if "-c" not in args and "-S" not in args:
+        return False
+    # configure checks are not part of build cost worth optimizing
+    return not os.path.basename(sources[0]).startswith("conftest")
+
+
+def record(args, compiler, start, wall, returncode, usage):
+    # usage is resource usage of this compiler process only, from wait4
+    sources = get_sources(compiler[1:])
+    rss = usage.ru_maxrss
+    if platform != "darwin":
+        rss *= 1024
+
+    connection = open_database(args.database)
+    with connection:
+        flags = get_flags(compiler[1:], sources)
+        connection.execute(
+            "INSERT OR IGNORE INTO flags (value) VALUES (?)", (flags,)
+        )
+        flags_id = connection.execute(
+            "SELECT id FROM flags WHERE value = ?", (flags,)
+        ).fetchone()[0]
+        connection.execute(
+            "INSERT INTO compilations (component, variant, tree, kind, source, "
+            "object, multilib, flags, start, wall, cpu, rss, returncode) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                args.component,
+                args.variant,
+                args.tree,
+                args.kind,
+                os.path.abspath(sources[0]),
+                get_object(compiler[1:]),
+                get_multilib(compiler[1:], args.kind),
+                flags_id,
+                start,
+                wall,
+                usage.ru_utime + usage.ru_stime,
+                rss,
+                returncode,
+            ),
+        )
+    connection.close()
+
+
+def execute(args):
+    compiler = args.compiler
+    if len(compiler) != 0 and compiler[0] == "--":
+        compiler = compiler[1:]
+    if len(compiler) == 0:
+        print("compile_profiler: compiler not provided", file=sys.stderr)
+        return -1
+
+    if not is_translation_unit(compiler[1:], get_sources(compiler[1:])):
+        os.execvp(compiler[0], compiler)
+
+    start = time.time()
+    begin = time.perf_counter()
+    process = subprocess.Popen(compiler)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    returncode = process.returncode
+    wall = time.perf_counter() - begin
+
+    try:
+        record(args, compiler, start, wall, returncode, usage)
+    except sqlite3.Error as error:
+        # profiling must never break the build
+        print("compile_profiler: can't record:", error, file=sys.stderr)
+    return returncode
+
+
+def get_longest_chain(compilations):
+    # Longest chain of compilations where each one starts after the previous
+    # finished. It is based on observed timestamps only, not on dependencies
+    # between files, so it shows where build was serialized, not why
+    compilations = sorted(compilations, key=lambda c: c["start"] + c["wall"])
+    ends = [c["start"] + c["wall"] for c in compilations]
+    best_prefix = []
+    previous = []
+    for index, compilation in enumerate(compilations):
+        count = bisect.bisect_right(ends, compilation["start"], 0, index)
+        length = compilation["wall"]
+        predecessor = None
+        if count > 0:
+            length += best_prefix[count - 1][0]
+            predecessor = best_prefix[count - 1][1]
+        previous.append(predecessor)
+        if index == 0 or length > best_prefix[index - 1][0]:
+            best_prefix.append((length, index))
+        else:
+            best_prefix.append(best_prefix[index - 1])
+
+    if len(compilations) == 0:
+        return 0, []
+
+    length, index = best_prefix[-1]
+    path = []
+    while index is not None:
+        path.append(compilations[index])
+        index = previous[index]
+    path.reverse()
+    return length, path
+
+
+def report(database, top, component=None):
+    if not os.path.exists(database):
+        print("No profile database:", database)
+        return -1
+
+    connection = open_database(database)
+    connection.row_factory = sqlite3.Row
+    query = "SELECT * FROM compilations"
+    parameters = ()
+    if component is not None:
+        query += " WHERE component = ?"
+        parameters = (component,)
+    compilations = connection.execute(query, parameters).fetchall()
+    connection.close()
+
+    if len(compilations) == 0:
+        print("No compilations recorded")
+        return 0
+
+    print_report(compilations, top)
+    return 0
+
+
+def format_build(compilation):
+    variant = (
+        compilation["variant"]
+        if len(compilation["variant"]) != 0
+        else "default"
+    )
+    if len(compilation["tree"]) == 0:
+        return variant
+    return variant + ":" + compilation["tree"]
+
+
+def print_report(compilations, top):
+    total_wall = sum(c["wall"] for c in compilations)
+    total_cpu = sum(c["cpu"] for c in compilations)
+    span = max(c["start"] + c["wall"] for c in compilations) - min(
+        c["start"] for c in compilations
+    )
+    print("Compilations: {}".format(len(compilations)))
+    print(
+        "Total wall: {:.1f}s, total CPU: {:.1f}s, span: {:.1f}s, "
+        "average parallelism: {:.1f}".format(
+            total_wall, total_cpu, span, total_wall / span if span > 0 else 1
+        )
+    )
+
+    print()
+    print("Top {} files by wall time:".format(top))
+    print(
+        "  {:>8} {:>8} {:>8}  {:<10} {:<30} {:<30} {}".format(
+            "wall[s]",
+            "cpu[s]",
+            "rss[MiB]",
+            "component",
+            "build",
+            "multilib",
+            "source",
+        )
+    )
+    for c in sorted(compilations, key=lambda c: c["wall"], reverse=True)[:top]:
+        print(
+            "  {:>8.2f} {:>8.2f} {:>8.1f}  {:<10} {:<30} {:<30} {}".format(
+                c["wall"],
+                c["cpu"],
+                c["rss"] / (1024 * 1024),
+                c["component"],
+                format_build(c),
+                c["multilib"],
+                c["source"],
+            )
+        )
+
+    # Target libraries are built for every variant and tree, i.e. regular and
+    # nano, so totals are split by them
+    print()
+    print("Totals per variant, build tree and multilib:")
+    print(
+        "  {:>6} {:>10} {:>10}  {:<10} {:<30} {}".format(
+            "files", "wall[s]", "cpu[s]", "component", "build", "multilib"
+        )
+    )
+    totals = {}
+    for c in compilations:
+        key = (c["component"], format_build(c), c["multilib"])
+        count, wall, cpu = totals.get(key, (0, 0, 0))
+        totals[key] = (count + 1, wall + c["wall"], cpu + c["cpu"])
+    for key, value in sorted(
+        totals.items(), key=lambda item: item[1][1], reverse=True
+    ):
+        print(
+            "  {:>6} {:>10.1f} {:>10.1f}  {:<10} {:<30} {}".format(
+                value[0], value[1], value[2], key[0], key[1], key[2]
+            )
+        )
+
+    length, path = get_longest_chain(compilations)
+    print()
+    print(
+        "Longest chain of sequential compilations: {:.1f}s through {} "
+        "compilations, longest steps:".format(length, len(path))
+    )
+    for c in sorted(path, key=lambda c: c["wall"], reverse=True)[:top]:
+        print(
+            "  {:>8.2f}  {:<10} {:<30} {:<30} {}".format(
+                c["wall"],
+                c["component"],
+                format_build(c),
+                c["multilib"],
+                c["source"],
+            )
+        )
+
+
+def main():
+    args = parse_arguments()
+    if args.command == "exec":
+        sys.exit(execute(args))
+    sys.exit(report(args.database, args.top, args.component))
+
+
+if __name__ == "__main__":
+    main()
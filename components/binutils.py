@@ -21,7 +21,8 @@
 #
 
 
-from components.recipe_base import RecipeBase
+from components.recipe_base import RecipeBase, get_build_key, get_sources_lock
+from components.target_flags import default_flag_profile, get_variant_name
 from sys import platform 
 
 import subprocess
@@ -30,12 +31,54 @@ import os
 is_build_recipe = True
 
 
+build_profiles = {
+    "full": {
+        "configure": ["--enable-gold"],
+        "installed": ["bin/{target}-ld.gold", "bin/{target}-gprof"],
+    },
+    # Yasld needs only assembler, bfd linker and binary utilities
+    "minimal": {
+        "configure": ["--disable-gold", "--disable-gprofng"],
+        "exclude": [
+            "gold/",
+            "gprofng/",
+            "gprof/",
+            "binutils/testsuite/",
+            "gas/testsuite/",
+            "ld/testsuite/",
+        ],
+    },
+}
+
+
 class BinutilsRecipe(RecipeBase):
     version = "2.42"
     sha256 = "f6e4d41fd5fc778b06b7891457b3620da5ecea1006c6a4a41ae998109f85a800"
     target = "arm-none-eabi"
-
-    def __init__(self, output_directory, prefix, skip_verification):
+    workspace_size = 700
+    variant_size = 2300
+    # Host tools only, each subdirectory installs own files without
+    # multilib loops
+    parallel_install = True
+    installed_files = [
+        "bin/{target}-addr2line",
+        "bin/{target}-ar",
+        "bin/{target}-as",
+        "bin/{target}-ld",
+        "bin/{target}-ld.bfd",
+        "bin/{target}-nm",
+        "bin/{target}-objcopy",
+        "bin/{target}-objdump",
+        "bin/{target}-ranlib",
+        "bin/{target}-readelf",
+        "bin/{target}-size",
+        "bin/{target}-strip",
+        "{target}/bin/as",
+        "{target}/bin/ld",
+        "{target}/lib/ldscripts/armelf.x",
+    ]
+
+    def __init__(self, output_directory, prefix, skip_verification, **kwargs):
         super().__init__(
             name="binutils",
             source="https://ftp.gnu.org/gnu/binutils/binutils-{version}.tar.xz".format(
@@ -43,20 +86,28 @@ class BinutilsRecipe(RecipeBase):
             ),
             output=output_directory,
             sha=BinutilsRecipe.sha256,
-            skip_verification=skip_verification
+            skip_verification=skip_verification,
+            profiles=build_profiles,
+            **kwargs
         )
 
         self.prefix = prefix
-
-    def configure(self):
         self.sources_root = (
             self.sources_directory
             / self.name
             / "binutils-{version}".format(version=BinutilsRecipe.version)
         )
-        print(" - Configure:", self.sources_root)
-        self.build_directory = self.sources_root / "build"
-        self.build_directory.mkdir(parents=True, exist_ok=True)
+        # Binutils are host tools and flag profiles change only target
+        # libraries, so variants of the same target share one build tree and
+        # install it into own prefix
+        self.tree_key = get_tree_key(self.target, self.build_profile)
+        self.build_directory = self.sources_root / (
+            "build-" + self.tree_key if len(self.tree_key) != 0 else "build"
+        )
+
+    def patch(self):
+        if os.path.exists(self.sources_root / ".cppflags_done"):
+            return
 
         if platform == "darwin":
             command = "gsed"
@@ -70,59 +121,84 @@ class BinutilsRecipe(RecipeBase):
             cwd=self.sources_root,
         )
         assert result.returncode == 0
+        (self.sources_root / ".cppflags_done").touch()
 
+    def configure(self):
+        print(" - Configure:", self.sources_root)
+        self.build_directory.mkdir(parents=True, exist_ok=True)
 
-        args = ["../configure"]
-        args.extend(
-            [
-                "--target={target}".format(target=BinutilsRecipe.target),
-                "--prefix={prefix}".format(prefix=self.prefix),
-                "--with-sysroot={prefix}/{target}".format(
-                    prefix=self.prefix, target=BinutilsRecipe.target
-                ),
-                "--enable-multilib",
-                "--enable-interwork",
-                "--with-gnu-as",
-                "--with-gnu-ld",
-                "--disable-nls",
-                "--enable-ld=default",
-                "--enable-gold",
-                "--enable-plugins",
-                "--enable-deterministic-archives",
-            ]
-        )
-
-        print(" - Configure called with:", subprocess.list2cmdline(args))
-        self.env = os.environ.copy()
+        self.env = self.profile_host_compilers(os.environ.copy())
         self.env[
             "CXXFLAGS"
         ] = "-O2 -std=c++11"
 
-        result = subprocess.run(
-            subprocess.list2cmdline(args), 
-            shell=True, 
-            cwd=self.build_directory,
-            env=self.env
-        )
-        assert result.returncode == 0
+        # Tree is configured once, prefix is overridden on install and
+        # sysroot inside of prefix is relocated by binutils
+        with get_sources_lock(str(self.build_directory)):
+            if os.path.exists(self.build_directory / ".configure_done"):
+                return
+
+            args = ["../configure"]
+            args.extend(
+                [
+                    "--target={target}".format(target=self.target),
+                    "--prefix={prefix}".format(prefix=self.prefix),
+                    "--with-sysroot={prefix}/{target}".format(
+                        prefix=self.prefix, target=self.target
+                    ),
+                    "--enable-multilib",
+                    "--enable-interwork",
+                    "--with-gnu-as",
+                    "--with-gnu-ld",
+                    "--disable-nls",
+                    "--enable-ld=default",
+                    "--enable-plugins",
+                    "--enable-deterministic-archives",
+                ]
+            )
+            args.extend(self.get_profile_option("configure"))
+
+            print(" - Configure called with:", subprocess.list2cmdline(args))
+            result = subprocess.run(
+                subprocess.list2cmdline(args), 
+                shell=True, 
+                cwd=self.build_directory,
+                env=self.env
+            )
+            assert result.returncode == 0
+            (self.build_directory / ".configure_done").touch()
 
 
     def compile(self):
-        result = subprocess.run(
-            "make -j$(nproc)",
-            shell=True,
-            cwd=self.build_directory,
-        )
-        assert result.returncode == 0
+        # The first variant of target builds, the others wait for it
+        with get_sources_lock(str(self.build_directory)):
+            result = subprocess.run(
+                "make -j{jobs}".format(jobs=self.make_jobs),
+                shell=True,
+                cwd=self.build_directory,
+            )
+            assert result.returncode == 0
 
 
 
     def install(self):
-        result = subprocess.run("make install", shell=True, cwd=self.build_directory)
-        assert result.returncode == 0
+        with get_sources_lock(str(self.build_directory)):
+            self.make_install(
+                self.build_directory,
+                "{target} prefix={prefix} exec_prefix={prefix}".format(
+                    target="install-strip" if self.strip else "install",
+                    prefix=self.prefix,
+                ),
+            )
+
+
 
 
+def get_tree_key(target, build_profile):
+    return get_build_key(
+        get_variant_name(target, default_flag_profile), build_profile
+    )
 
 
-def get_recipe(output_directory, prefix, skip_verification):
-    return BinutilsRecipe(output_directory, prefix, skip_verification)
+def get_recipe(output_directory, prefix, skip_verification, **kwargs):
+    return BinutilsRecipe(output_directory, prefix, skip_verification, **kwargs)
@@ -23,40 +23,154 @@
 
 from components.recipe_base import RecipeBase
 
+import benchmark_toolchain
 import subprocess
 import os
+import shlex
 import shutil
+import time
+from sys import platform
 from pathlib import Path
 
 is_build_recipe = True
 
 
+build_profiles = {
+    "full": {
+        "languages": ["c", "c++"],
+    },
+    # Front ends and runtimes that Yasld never uses are not even extracted,
+    # toplevel configure skips missing directories
+    "minimal": {
+        "languages": ["c", "c++"],
+        "configure": ["--disable-libcc1", "--disable-gcov"],
+        "exclude": [
+            "gcc/testsuite/",
+            "gcc/ada/",
+            "gcc/d/",
+            "gcc/fortran/",
+            "gcc/go/",
+            "gcc/m2/",
+            "gcc/rust/",
+            "gcc/jit/",
+            "libada/",
+            "libgfortran/",
+            "libgm2/",
+            "libgo/",
+            "libgrust/",
+            "libphobos/",
+            "libsanitizer/",
+            "gotools/",
+        ],
+    },
+}
+
+
+def get_host_compiler():
+    # gcc configure uses CC from environment, on darwin 'gcc' is clang
+    compiler = os.environ.get("CC", "gcc")
+    try:
+        result = subprocess.run(
+            shlex.split(compiler) + ["--version"], capture_output=True, text=True
+        )
+    except OSError:
+        return None
+    if result.returncode != 0:
+        return None
+    version = result.stdout.lower()
+    if "clang" in version:
+        return "clang"
+    if "free software foundation" in version:
+        return "gcc"
+    return None
+
+
+def get_llvm_tool(name):
+    if shutil.which(name) is not None:
+        return shutil.which(name)
+    if platform == "darwin" and shutil.which("xcrun") is not None:
+        result = subprocess.run(
+            ["xcrun", "--find", name], capture_output=True, text=True
+        )
+        if result.returncode == 0:
+            return result.stdout.strip()
+    return None
+
+
+def check_optimized_compiler():
+    compiler = get_host_compiler()
+    if compiler is None:
+        return "optimized compiler needs GCC or clang as host compiler"
+    if compiler == "clang":
+        if get_llvm_tool("llvm-profdata") is None:
+            return "optimized compiler with clang needs llvm-profdata"
+        # GNU ld can't link LLVM bitcode without plugin
+        if platform != "darwin" and shutil.which("ld.lld") is None:
+            return "optimized compiler with clang needs ld.lld"
+    return None
+
+
+# Built once into <build-dir>/host-libraries and shared by all variants
+host_libraries = [
+    ("gmp", []),
+    (
+        "mpfr",
+        ["--with-gmp={host}"],
+    ),
+    (
+        "mpc",
+        ["--with-gmp={host}", "--with-mpfr={host}"],
+    ),
+    (
+        "isl",
+        ["--with-gmp-prefix={host}"],
+    ),
+]
+
+
+def get_build_mode(options):
+    # Instrumented and PGO trees must never be mixed with regular build
+    if options.get("optimized_compiler", False):
+        return "pgo"
+    return ""
+
+
 class GccRecipe(RecipeBase):
     gcc_version = "14.1.0"
     sha256 = "e283c654987afe3de9d8080bc0bd79534b5ca0d681a73a11ff2b5d3767426840"
     target = "arm-none-eabi"
-
-    def __init__(self, output_directory, prefix, skip_verification):
+    workspace_size = 2000
+    variant_size = 12000
+    installed_files = [
+        "bin/{target}-cpp",
+        "bin/{target}-g++",
+        "bin/{target}-gcc",
+        "bin/{target}-gcc-ar",
+        "bin/{target}-gcc-nm",
+        "bin/{target}-gcc-ranlib",
+    ]
+
+    def __init__(self, output_directory, prefix, skip_verification, **kwargs):
         super().__init__(
             name="gcc",
             source="https://ftp.gnu.org/gnu/gcc/gcc-{version}/gcc-{version}.tar.xz".format(
                 version=GccRecipe.gcc_version
             ),
             output=output_directory,
-            sha=GccRecipe.sha256,minor
-            skip_verification=skip_verification
+            sha=GccRecipe.sha256,
+            skip_verification=skip_verification,
+            profiles=build_profiles,
+            build_mode=get_build_mode(kwargs),
+            **kwargs
         )
         self.prefix = prefix
 
-        self.env = os.environ.copy()
-        self.env[
-            "CFLAGS_FOR_TARGET"
-        ] = "-g -Os -ffunction-sections -fdata-sections \
--msingle-pic-base -mno-pic-data-is-text-relative -fPIC"
+        self.env = self.profile_host_compilers(os.environ.copy())
+        self.env["CFLAGS_FOR_TARGET"] = self.target_cflags
 
         self.env["CXXFLAGS_FOR_TARGET"] = self.env["CFLAGS_FOR_TARGET"]
 
-        self.env_nano = os.environ.copy()
+        self.env_nano = self.profile_host_compilers(os.environ.copy(), "build_nano")
         self.env_nano["CFLAGS_FOR_TARGET"] = self.env["CFLAGS_FOR_TARGET"]
         self.env_nano["CXXFLAGS_FOR_TARGET"] = (
             self.env_nano["CFLAGS_FOR_TARGET"] + " -fno-exceptions"
@@ -68,31 +182,200 @@ class GccRecipe(RecipeBase):
             / "gcc-{version}".format(version=GccRecipe.gcc_version)
         )
 
-        self.nano_build_directory = self.sources_root / "build_nano"
-        self.nano_build_directory.mkdir(parents=True, exist_ok=True)
-        self.build_directory = self.sources_root / "build"
-        self.build_directory.mkdir(parents=True, exist_ok=True)
+        self.nano_build_directory = self.sources_root / self.variant_directory(
+            "build_nano"
+        )
+        self.build_directory = self.sources_root / self.variant_directory("build")
+
+        # gmp, mpfr, mpc and isl are host only, so all variants share them
+        self.host_libraries_directory = (
+            Path(self.output) / "host-libraries"
+        ).resolve()
+
+        if "optimized_compiler" in kwargs:
+            self.optimized_compiler = kwargs["optimized_compiler"]
+        else:
+            self.optimized_compiler = False
+        if self.optimized_compiler:
+            error = check_optimized_compiler()
+            if error is not None:
+                raise RuntimeError(error)
+        self.host_compiler = get_host_compiler()
+        self.multilibs = None
+        self.profile_directory = (
+            self.sources_root / self.variant_directory("pgo_profile")
+        ).resolve()
 
     def patch(self):
         self.do_patches(self.sources_root)
 
+        print(" - Fixing permissions ")
+        result = subprocess.run(
+            "chmod +x configure install-sh move-if-change libgcc/mkheader.sh contrib/download_prerequisites",
+            shell=True,
+            cwd=self.sources_root,
+        )
+        assert result.returncode == 0
+
+        # Host libraries are shared and outlive sources tree, i.e. on ramdisk
+        if not self.are_host_libraries_built() and not os.path.exists(
+            self.sources_root / ".prerequisites_done"
+        ):
+            self.download_prerequisites()
+
+        self.build_host_libraries()
+
+    def are_host_libraries_built(self):
+        return all(
+            (Path(self.output) / (library + "_host_done")).exists()
+            for library, _ in host_libraries
+        )
+
+    def download_prerequisites(self):
+        # download_prerequisites skips archives that already exist, so they
+        # are cached with other downloads
+        for library, _ in host_libraries:
+            for archive in self.download_directory.glob(library + "-*.tar.*"):
+                if not (self.sources_root / archive.name).exists():
+                    shutil.copyfile(archive, self.sources_root / archive.name)
+
+        result = subprocess.run(
+            "contrib/download_prerequisites",
+            shell=True,
+            cwd=self.sources_root,
+        )
+        assert result.returncode == 0
+
+        for library, _ in host_libraries:
+            for archive in self.sources_root.glob(library + "-*.tar.*"):
+                shutil.copyfile(archive, self.download_directory / archive.name)
+        (self.sources_root / ".prerequisites_done").touch()
+
+    def build_host_libraries(self):
+        for library, library_args in host_libraries:
+            # In tree libraries would be built again for each variant
+            link = self.sources_root / library
+            if link.is_symlink():
+                link.unlink()
+
+            done_flag_file = Path(self.output) / (library + "_host_done")
+            if done_flag_file.exists():
+                continue
+
+            candidates = sorted(self.sources_root.glob(library + "-*"))
+            candidates = [path for path in candidates if path.is_dir()]
+            assert len(candidates) == 1
+
+            build_directory = self.sources_root / "build-host" / library
+            build_directory.mkdir(parents=True, exist_ok=True)
+
+            args = [str(candidates[0] / "configure")]
+            args.extend(
+                [
+                    "--prefix={host}".format(host=self.host_libraries_directory),
+                    "--disable-shared",
+                    "--enable-static",
+                    "--with-pic",
+                ]
+            )
+            args.extend(
+                [
+                    arg.format(host=self.host_libraries_directory)
+                    for arg in library_args
+                ]
+            )
+            print(
+                " - Configure host library {} with: {}".format(
+                    library, subprocess.list2cmdline(args)
+                )
+            )
+            result = subprocess.run(
+                subprocess.list2cmdline(args),
+                shell=True,
+                cwd=build_directory,
+            )
+            assert result.returncode == 0
+
+            result = subprocess.run(
+                "make -j{jobs} && make install".format(jobs=self.make_jobs),
+                shell=True,
+                cwd=build_directory,
+            )
+            assert result.returncode == 0
+            done_flag_file.touch()
+
+    def is_trained(self):
+        return (self.profile_directory / ".training_done").exists()
+
+    def host_environment(self):
+        env = self.env.copy()
+        if not self.optimized_compiler:
+            return env
+
+        # Cross compiler is not bootstrapped, so bootstrap-lto and
+        # profiledbootstrap are done by hand: instrumented build, training,
+        # then rebuild with profile feedback and LTO
+        if not self.is_trained():
+            if self.host_compiler == "clang":
+                generate = "-fprofile-instr-generate={profile}/compiler-%m.profraw"
+            else:
+                generate = "-fprofile-generate={profile}"
+            generate = generate.format(profile=self.profile_directory)
+            flags = "-O2 " + generate
+            env["LDFLAGS"] = generate
+        elif self.host_compiler == "clang":
+            flags = "-O2 -flto=thin -fprofile-instr-use={profile} \
+-Wno-profile-instr-unprofiled -Wno-profile-instr-out-of-date".format(
+                profile=self.profile_directory / "compiler.profdata"
+            )
+            env["LDFLAGS"] = "-O2 -flto=thin"
+            if platform != "darwin":
+                env["LDFLAGS"] += " -fuse-ld=lld"
+            # host libraries are archives with LLVM bitcode
+            for variable, tool in [
+                ("AR", "llvm-ar"),
+                ("RANLIB", "llvm-ranlib"),
+                ("NM", "llvm-nm"),
+            ]:
+                if get_llvm_tool(tool) is not None:
+                    env[variable] = get_llvm_tool(tool)
+        else:
+            flags = "-O2 -flto=auto -fprofile-use={profile} \
+-fprofile-partial-training -Wno-missing-profile".format(
+                profile=self.profile_directory
+            )
+            env["LDFLAGS"] = "-O2 -flto=auto"
+            # host libraries are archives, they need ar with LTO plugin
+            if shutil.which("gcc-ar") is not None:
+                env["AR"] = "gcc-ar"
+                env["RANLIB"] = "gcc-ranlib"
+                env["NM"] = "gcc-nm"
+
+        env["CFLAGS"] = flags
+        env["CXXFLAGS"] = flags
+        return env
+
     def configure(self):
         print(" - Configure:", self.sources_root)
+        self.nano_build_directory.mkdir(parents=True, exist_ok=True)
+        self.build_directory.mkdir(parents=True, exist_ok=True)
 
         args = ["../configure"]
         args.extend(
             [
-                "--target={target}".format(target=GccRecipe.target),
+                "--target={target}".format(target=self.target),
                 "--prefix={prefix}".format(prefix=self.prefix),
                 "--with-sysroot={prefix}/{target}".format(
-                    prefix=self.prefix, target=GccRecipe.target
+                    prefix=self.prefix, target=self.target
                 ),
                 "--with-native-system-header-dir=/include",
                 "--libexecdir={prefix}/{target}/lib".format(
-                    prefix=self.prefix, target=GccRecipe.target
+                    prefix=self.prefix, target=self.target
                 ),
                 "--with-pic",
-                "--enable-languages=c,c++",
+                "--enable-languages={}".format(
+                    ",".join(self.get_profile_option("languages"))
+                ),
                 "--enable-plugins",
                 "--disable-decimal-float",
                 "--disable-libffi",
@@ -110,13 +393,13 @@ class GccRecipe(RecipeBase):
                 "--with-system-zlib",
                 "--with-newlib",
                 "--with-headers={prefix}/{target}/include".format(
-                    prefix=self.prefix, target=GccRecipe.target
+                    prefix=self.prefix, target=self.target
                 ),
                 "--with-python-dir=share/gcc-arm-none-eabi",
-                # "--with-gmp",
-                # "--with-mpfr",
-                "--with-isl",
-                # "--with-mpc",
+                "--with-gmp={host}".format(host=self.host_libraries_directory),
+                "--with-mpfr={host}".format(host=self.host_libraries_directory),
+                "--with-isl={host}".format(host=self.host_libraries_directory),
+                "--with-mpc={host}".format(host=self.host_libraries_directory),
                 "--with-libelf",
                 "--enable-gnu-indirect-function",
                 "--with-host-libstdc++='-static-libgcc -Wl,-Bstatic,-lstdc++,-Bdynamic -lm'"
@@ -124,31 +407,14 @@ class GccRecipe(RecipeBase):
                 "--with-multilib-list=rmprofile",
             ]
         )
-        print(" - Fixing permissions ")
-        result = subprocess.run(
-            "chmod +x ../configure ../install-sh ../move-if-change ../libgcc/mkheader.sh ../contrib/download_prerequisites",
-            shell=True,
-            cwd=self.build_directory,
-            env=self.env,
-        )
-
-        print(self.sources_directory)
-        result = subprocess.run(
-            "contrib/download_prerequisites",
-            shell=True,
-            cwd=self.sources_root,
-            env=self.env,
-        )
-        
-        assert result.returncode == 0
-
+        args.extend(self.get_profile_option("configure"))
         print(" - Configure called with:", subprocess.list2cmdline(args))
         if not os.path.exists(self.build_directory / ".configure_done"):
             result = subprocess.run(
                 subprocess.list2cmdline(args),
                 shell=True,
                 cwd=self.build_directory,
-                env=self.env,
+                env=self.host_environment(),
             )
 
             assert result.returncode == 0
@@ -169,18 +435,38 @@ class GccRecipe(RecipeBase):
             assert result.returncode == 0
             (self.nano_build_directory / ".configure_done").touch()
 
+    def get_make_command(self, tree):
+        command = 'make -j{jobs} INHIBIT_LIBC_CFLAGS="-DUSE_TM_CLONE_REGISTRY=0"'.format(
+            jobs=self.make_jobs
+        )
+        if self.compile_profile is not None:
+            # Prefixes CC_FOR_TARGET and CXX_FOR_TARGET in toplevel Makefile,
+            # in-tree xgcc command line stays untouched
+            command += " " + shlex.quote(
+                "STAGE_CC_WRAPPER=" + self.profiled_compiler("", "target", tree)
+            )
+        return command
+
     def compile(self):
+        # Target libraries are never sharded per multilib like newlib is.
+        # libgcc can't be configured outside of gcc tree and multilib
+        # subdirectories created by config-ml.in are built only through
+        # multi-do loop of default multilib, so --shard-multilibs covers
+        # newlib only
+        if self.optimized_compiler and not self.is_trained():
+            self.train_compiler(self.get_make_command("pgo_training"))
+
         result = subprocess.run(
-            'make -j$(nproc) INHIBIT_LIBC_CFLAGS="-DUSE_TM_CLONE_REGISTRY=0"',
+            self.get_make_command("build"),
             shell=True,
             cwd=self.build_directory,
-            env=self.env,
+            env=self.host_environment(),
         )
 
         assert result.returncode == 0
 
         result = subprocess.run(
-            'make -j$(nproc) INHIBIT_LIBC_CFLAGS="-DUSE_TM_CLONE_REGISTRY=0"',
+            self.get_make_command("build_nano"),
             shell=True,
             cwd=self.nano_build_directory,
             env=self.env_nano,
@@ -188,11 +474,116 @@ class GccRecipe(RecipeBase):
 
         assert result.returncode == 0
 
-    def install(self):
-        print("Installing GCC nano libraries")
+        if self.optimized_compiler:
+            self.report_speedup()
 
-        subprocess.run("make install", shell=True, cwd=self.build_directory)
-        
+    def get_corpus_commands(self, build_directory):
+        result = subprocess.run(
+            "./gcc/xgcc -print-multi-lib",
+            shell=True,
+            cwd=build_directory,
+            capture_output=True,
+            text=True,
+        )
+        assert result.returncode == 0
+
+        libstdcxx_includes = (
+            build_directory / self.target / "libstdc++-v3" / "include"
+        ).resolve()
+        commands = []
+        for _, multilib_flags in benchmark_toolchain.parse_multilibs(
+            result.stdout
+        ):
+            for source in benchmark_toolchain.get_corpus():
+                if source.suffix == ".cpp":
+                    # libstdc++ is not installed yet, headers from build tree
+                    # are used like for target libraries
+                    command = [
+                        "./gcc/xg++",
+                        "-B./gcc/",
+                        "-nostdinc++",
+                        "-isystem",
+                        str(libstdcxx_includes / self.target),
+                        "-isystem",
+                        str(libstdcxx_includes),
+                        "-isystem",
+                        str(
+                            (self.sources_root / "libstdc++-v3" / "libsupc++").resolve()
+                        ),
+                    ]
+                else:
+                    command = ["./gcc/xgcc", "-B./gcc/"]
+                command.extend(
+                    benchmark_toolchain.get_compile_flags(
+                        source, multilib_flags, "full"
+                    )
+                )
+                command.extend(["-S", "-o", os.devnull, str(source.resolve())])
+                commands.append(command)
+        return commands
+
+    def train_compiler(self, command):
+        print(" - Building instrumented compiler")
+        self.profile_directory.mkdir(parents=True, exist_ok=True)
+        # Building target libraries is part of the training
+        result = subprocess.run(
+            command,
+            shell=True,
+            cwd=self.build_directory,
+            env=self.host_environment(),
+        )
+        assert result.returncode == 0
+
+        print(" - Training compiler with corpus")
+        for args in self.get_corpus_commands(self.build_directory):
+            result = subprocess.run(args, cwd=self.build_directory)
+            assert result.returncode == 0
+
+        if self.host_compiler == "clang":
+            # clang writes raw profiles, they are indexed before use
+            result = subprocess.run(
+                [
+                    get_llvm_tool("llvm-profdata"),
+                    "merge",
+                    "-output={}".format(self.profile_directory / "compiler.profdata"),
+                ]
+                + [str(path) for path in self.profile_directory.glob("*.profraw")]
+            )
+            assert result.returncode == 0
+
+        print(" - Rebuilding compiler with profile feedback and LTO")
+        shutil.rmtree(self.build_directory)
+        (self.profile_directory / ".training_done").touch()
+        self.configure()
+
+    def measure_corpus(self, build_directory):
+        total = 0
+        for args in self.get_corpus_commands(build_directory):
+            best = None
+            for _ in range(3):
+                start = time.perf_counter()
+                result = subprocess.run(args, cwd=build_directory)
+                elapsed = time.perf_counter() - start
+                assert result.returncode == 0
+                if best is None or elapsed < best:
+                    best = elapsed
+            total += best
+        return total
+
+    def report_speedup(self):
+        # Nano tree is configured with the same arguments and default host
+        # flags, so its compiler is the regular build
+        regular = self.measure_corpus(self.nano_build_directory)
+        optimized = self.measure_corpus(self.build_directory)
+        print(
+            " - Optimized compiler speedup: {:.2f}x (regular: {:.2f}s, optimized: {:.2f}s)".format(
+                regular / optimized, regular, optimized
+            )
+        )
+
+    def get_multilibs(self):
+        if self.multilibs is not None:
+            return self.multilibs
         result = subprocess.run(
             "./gcc/gcc-cross -print-multi-lib",
             shell=True,
@@ -200,14 +591,49 @@ class GccRecipe(RecipeBase):
             capture_output=True,
             text=True,
         )
-
         assert result.returncode == 0
+        self.multilibs = [
+            arch for arch, _ in benchmark_toolchain.parse_multilibs(result.stdout)
+        ]
+        return self.multilibs
+
+    def get_installed_files(self):
+        libexec = "{target}/lib/gcc/{target}/{version}".format(
+            target=self.target, version=GccRecipe.gcc_version
+        )
+        files = super().get_installed_files() + [
+            libexec + "/cc1",
+            libexec + "/cc1plus",
+            libexec + "/collect2",
+            libexec + "/lto-wrapper",
+        ]
+        for arch in self.get_multilibs():
+            libgcc = "lib/gcc/{target}/{version}/{arch}/libgcc.a".format(
+                target=self.target, version=GccRecipe.gcc_version, arch=arch
+            )
+            libraries = Path(self.target) / "lib" / arch
+            files.extend(
+                [
+                    libgcc,
+                    str(libraries / "libstdc++.a"),
+                    str(libraries / "libstdc++_nano.a"),
+                    str(libraries / "libsupc++_nano.a"),
+                ]
+            )
+        return files
 
-        for lib in result.stdout.split("\n"):
-            print(lib)
-            arch = lib.split(";")[0].strip()
-            if len(arch) == 0:
-                continue
+    def install(self):
+        # Target libraries keep debug information, only host tools are stripped
+        if self.strip:
+            self.make_install(
+                self.build_directory,
+                "installdirs install-strip-host install-target",
+            )
+        else:
+            self.make_install(self.build_directory)
+
+        print("Installing GCC nano libraries")
+        for arch in self.get_multilibs():
             print("Processing architecture:", arch)
             archpath = Path(self.nano_build_directory / self.target / arch)
 
@@ -235,8 +661,8 @@ class GccRecipe(RecipeBase):
 
 
 
-def get_recipe(output_directory, prefix, skip_verification):
-    return GccRecipe(output_directory, prefix, skip_verification)
+def get_recipe(output_directory, prefix, skip_verification, **kwargs):
+    return GccRecipe(output_directory, prefix, skip_verification, **kwargs)
 
 
-dependencies = ["newlib"]
+dependencies = ["binutils", "newlib"]
@@ -24,7 +24,10 @@ from components.recipe_base import RecipeBase
 
 import subprocess
 import os
+import shlex
+import shutil
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 is_build_recipe = True
@@ -34,8 +37,11 @@ class NewlibRecipe(RecipeBase):
     version = "4.4.0.20231231"
     sha256 = "0c166a39e1bf0951dfafcd68949fe0e4b6d3658081d6282f39aeefc6310f2f13"
     target = "arm-none-eabi"
+    workspace_size = 300
+    variant_size = 1700
+    installed_files = ["{target}/include/newlib.h", "{target}/include/stdio.h"]
 
-    def __init__(self, output_directory, prefix, skip_verification):
+    def __init__(self, output_directory, prefix, skip_verification, **kwargs):
         super().__init__(
             name="newlib",
             source="https://sourceware.org/pub/newlib/newlib-{version}.tar.gz".format(
@@ -43,14 +49,12 @@ class NewlibRecipe(RecipeBase):
             ),
             output=output_directory,
             sha=NewlibRecipe.sha256,
-            skip_verification=skip_verification
+            skip_verification=skip_verification,
+            **kwargs
         )
         self.prefix = prefix
         self.env = os.environ.copy()
-        self.env[
-            "CFLAGS_FOR_TARGET"
-        ] = "-g -Os -ffunction-sections -fdata-sections \
--msingle-pic-base -mno-pic-data-is-text-relative -fPIC"
+        self.env["CFLAGS_FOR_TARGET"] = self.target_cflags
 
         self.sources_root = (
             self.sources_directory
@@ -58,95 +62,129 @@ class NewlibRecipe(RecipeBase):
             / "newlib-{version}".format(version=NewlibRecipe.version)
         )
  
-        self.nano_build_directory = self.sources_root / "build-nano"
-        self.full_build_directory = self.sources_root / "build-full"
+        self.nano_build_directory = self.sources_root / self.variant_directory(
+            "build-nano"
+        )
+        self.full_build_directory = self.sources_root / self.variant_directory(
+            "build-full"
+        )
+
+        if "shard_multilibs" in kwargs:
+            self.shard_multilibs = kwargs["shard_multilibs"]
+        else:
+            self.shard_multilibs = False
+        self.shards_directory = self.sources_root / self.variant_directory(
+            "build-shards"
+        )
+        self.shards = None
+
+    def get_nano_configure_args(self):
+        return [
+            "--target={target}".format(target=self.target),
+            "--prefix={prefix}".format(prefix=self.prefix),
+            "--disable-newlib-supplied-syscalls",
+            "--enable-newlib-reent-small",
+            "--enable-newlib-retargetable-locking",
+            "--disable-newlib-fvwrite-in-streamio",
+            "--disable-newlib-fseek-optimization",
+            "--disable-newlib-wide-orient",
+            "--enable-newlib-nano-malloc",
+            "--disable-newlib-unbuf-stream-opt",
+            "--enable-lite-exit",
+            "--enable-newlib-global-atexit",
+            "--enable-newlib-nano-formatted-io",
+            "--disable-nls",
+            "--with-pic",
+        ]
+
+    def get_full_configure_args(self):
+        return [
+            "--target={target}".format(target=self.target),
+            "--prefix={prefix}".format(prefix=self.prefix),
+            "--enable-newlib-io-long-long",
+            "--enable-newlib-io-c99-formats",
+            "--enable-newlib-register-fini",
+            "--enable-newlib-retargetable-locking",
+            "--disable-newlib-supplied-syscalls",
+            "--disable-nls",
+            "--with-pic",
+        ]
 
     def configure(self):
+        if self.shard_multilibs:
+            # shards are configured together with compilation, each one as
+            # independent job
+            return
+
         print(" - Configure:", self.sources_root)
         args = ["../configure"]
 
         self.nano_build_directory.mkdir(parents=True, exist_ok=True)
         
-        args.extend(
-            [
-                "--target={target}".format(target=NewlibRecipe.target),
-                "--prefix={prefix}".format(prefix=self.prefix),
-                "--disable-newlib-supplied-syscalls",
-                "--enable-newlib-reent-small",
-                "--enable-newlib-retargetable-locking",
-                "--disable-newlib-fvwrite-in-streamio",
-                "--disable-newlib-fseek-optimization",
-                "--disable-newlib-wide-orient",
-                "--enable-newlib-nano-malloc",
-                "--disable-newlib-unbuf-stream-opt",
-                "--enable-lite-exit",
-                "--enable-newlib-global-atexit",
-                "--enable-newlib-nano-formatted-io",
-                "--disable-nls",
-                "--with-pic",
-            ]
-        )
+        args.extend(self.get_nano_configure_args())
 
         print(" - Configure called with:", subprocess.list2cmdline(args))
         result = subprocess.run(
             subprocess.list2cmdline(args),
             shell=True,
             cwd=self.nano_build_directory,
-            env=self.env,
+            env=self.get_tree_environment("build-nano"),
         )
         assert result.returncode == 0
 
         self.full_build_directory.mkdir(parents=True, exist_ok=True)
 
         args = ["../configure"]
-        args.extend(
-            [
-                "--target={target}".format(target=NewlibRecipe.target),
-                "--prefix={prefix}".format(prefix=self.prefix),
-                "--enable-newlib-io-long-long",
-                "--enable-newlib-io-c99-formats",
-                "--enable-newlib-register-fini",
-                "--enable-newlib-retargetable-locking",
-                "--disable-newlib-supplied-syscalls",
-                "--disable-nls",
-                "--with-pic",
-            ]
-        )
+        args.extend(self.get_full_configure_args())
 
         print(" - Configure called with:", subprocess.list2cmdline(args))
         result = subprocess.run(
             subprocess.list2cmdline(args),
             shell=True,
             cwd=self.full_build_directory,
-            env=self.env,
+            env=self.get_tree_environment("build-full"),
         )
         assert result.returncode == 0
 
+    def get_tree_environment(self, tree, flags=None):
+        if flags is None:
+            flags = []
+        env = self.env.copy()
+        # multilib flags are part of compiler, so every compile, assembly and
+        # link in the tree uses them
+        if self.compile_profile is not None or len(flags) != 0:
+            compiler = " ".join([self.target + "-gcc"] + flags)
+            cxx_compiler = " ".join([self.target + "-g++"] + flags)
+            env["CC_FOR_TARGET"] = self.profiled_compiler(compiler, "target", tree)
+            env["CXX_FOR_TARGET"] = self.profiled_compiler(
+                cxx_compiler, "target", tree
+            )
+        return env
+
 
     def compile(self):
+        if self.shard_multilibs:
+            self.run_shards(self.build_shard)
+            return
+
         result = subprocess.run(
-            "make -j$(nproc)",
+            "make -j{jobs}".format(jobs=self.make_jobs),
             shell=True,
             cwd=self.nano_build_directory,
-            env=self.env,
+            env=self.get_tree_environment("build-nano"),
         )
         assert result.returncode == 0
 
-        subprocess.run(
-            "make -j$(nproc)",
+        result = subprocess.run(
+            "make -j{jobs}".format(jobs=self.make_jobs),
             shell=True,
             cwd=self.full_build_directory,
-            env=self.env,
+            env=self.get_tree_environment("build-full"),
         )
         assert result.returncode == 0
 
 
-    def install(self):
-        result = subprocess.run(
-            "make install", shell=True, cwd=self.nano_build_directory
-        )
-        assert result.returncode == 0
-
+    def rename_to_nano(self):
         print(" - Rename library to nano")
         for path, _, files in os.walk(self.prefix):
             for file in files:
@@ -155,12 +193,171 @@ class NewlibRecipe(RecipeBase):
                 if "libc.a" in str(p) or "libg.a" in str(p) or "librdimon.a" in str(p):
                     os.rename(p, r)
 
+    def install(self):
+        if self.shard_multilibs:
+            self.install_shards()
+            return
+
+        # Target libraries keep debug information, so never install-strip
+        self.make_install(
+            self.nano_build_directory,
+            "install",
+            self.get_tree_environment("build-nano"),
+        )
+
+        self.rename_to_nano()
+
+        self.make_install(
+            self.full_build_directory,
+            "install",
+            self.get_tree_environment("build-full"),
+        )
+
+    def get_multilibs(self):
         result = subprocess.run(
-            "make install", shell=True, cwd=self.full_build_directory
+            [self.target + "-gcc", "-print-multi-lib"],
+            capture_output=True,
+            text=True,
         )
         assert result.returncode == 0
 
+        multilibs = []
+        for line in result.stdout.split("\n"):
+            if len(line.strip()) == 0:
+                continue
+            directory, flags = line.strip().split(";", 1)
+            flags = ["-" + flag for flag in flags.split("@") if len(flag) != 0]
+            multilibs.append((directory, flags))
+        return multilibs
+
+    def get_installed_files(self):
+        files = super().get_installed_files()
+        for directory, _ in self.get_multilibs():
+            libraries = Path(self.target) / "lib" / directory
+            for library in ["libc.a", "libc_nano.a", "libg_nano.a", "libm.a"]:
+                files.append(str(libraries / library))
+        return files
+
+    def get_shards(self):
+        if self.shards is not None:
+            return self.shards
+
+        self.shards = []
+        for directory, flags in self.get_multilibs():
+            for flavor, args in [
+                ("nano", self.get_nano_configure_args()),
+                ("full", self.get_full_configure_args()),
+            ]:
+                name = "{}-{}".format(
+                    flavor, "default" if directory == "." else directory.replace("/", "_")
+                )
+                self.shards.append(
+                    {
+                        "name": name,
+                        "flavor": flavor,
+                        "multilib": directory,
+                        "flags": flags,
+                        "args": args + ["--disable-multilib"],
+                        "build_directory": self.shards_directory / name,
+                        "stage_directory": self.shards_directory / (name + "-stage"),
+                    }
+                )
+        return self.shards
+
+    def get_shard_workers(self):
+        # Shards share cores given to this job, never more runs than cores
+        return max(1, min(len(self.get_shards()), self.make_jobs))
+
+    def run_shards(self, job):
+        shards = self.get_shards()
+        with ThreadPoolExecutor(max_workers=self.get_shard_workers()) as executor:
+            for result in [executor.submit(job, shard) for shard in shards]:
+                result.result()
+
+    def get_shard_jobs(self):
+        # Concurrent shards split cores between them
+        return max(1, self.make_jobs // self.get_shard_workers())
+
+    def get_shard_environment(self, shard):
+        return self.get_tree_environment(
+            "build-shards/" + shard["name"], shard["flags"]
+        )
+
+    def build_shard(self, shard):
+        build_directory = shard["build_directory"]
+        build_directory.mkdir(parents=True, exist_ok=True)
+        env = self.get_shard_environment(shard)
+
+        if not (build_directory / ".configure_done").exists():
+            args = [str((self.sources_root / "configure").resolve())]
+            args.extend(shard["args"])
+            print(
+                " - Configure shard {} called with: {}".format(
+                    shard["name"], subprocess.list2cmdline(args)
+                )
+            )
+            result = subprocess.run(
+                subprocess.list2cmdline(args),
+                shell=True,
+                cwd=build_directory,
+                env=env,
+            )
+            assert result.returncode == 0
+            (build_directory / ".configure_done").touch()
+
+        result = subprocess.run(
+            "make -j{jobs}".format(jobs=self.get_shard_jobs()),
+            shell=True,
+            cwd=build_directory,
+            env=env,
+        )
+        assert result.returncode == 0
+
+    def install_shard(self, shard):
+        if shard["stage_directory"].exists():
+            shutil.rmtree(shard["stage_directory"])
+        self.make_install(
+            shard["build_directory"],
+            "install DESTDIR={}".format(
+                shlex.quote(str(shard["stage_directory"].resolve()))
+            ),
+            self.get_shard_environment(shard),
+        )
+
+    def merge_shard(self, shard):
+        # Shards are built with --disable-multilib, so libraries land directly
+        # in <target>/lib and must be moved to multilib directory
+        staged_prefix = shard["stage_directory"] / str(self.prefix).lstrip("/")
+        libraries = Path(self.target) / "lib"
+        print(" - Merging shard", shard["name"])
+        for path, _, files in os.walk(staged_prefix):
+            for file in files:
+                source = Path(path) / file
+                relative = source.relative_to(staged_prefix)
+                if relative.parts[: len(libraries.parts)] == libraries.parts:
+                    relative = (
+                        libraries
+                        / shard["multilib"]
+                        / Path(*relative.parts[len(libraries.parts) :])
+                    )
+                target = Path(self.prefix) / relative
+                target.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copy2(source, target)
+
+    def install_shards(self):
+        self.run_shards(self.install_shard)
+
+        for shard in self.get_shards():
+            if shard["flavor"] == "nano":
+                self.merge_shard(shard)
+
+        self.rename_to_nano()
+
+        for shard in self.get_shards():
+            if shard["flavor"] == "full":
+                self.merge_shard(shard)
+
 
 
-def get_recipe(output_directory, prefix, skip_verification):
-    return NewlibRecipe(output_directory, prefix, skip_verification)
+def get_recipe(output_directory, prefix, skip_verification, **kwargs):
+    return NewlibRecipe(output_directory, prefix, skip_verification, **kwargs)
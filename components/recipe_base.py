@@ -31,11 +31,84 @@ from tqdm import tqdm
 import tarfile
 import zipfile
 import subprocess
+import shutil
+import threading
+import time
+
+from components.target_flags import flag_profiles, default_flag_profile
+from components.timings import record_timing
 
 is_build_recipe = False
 
 
+def get_available_memory():
+    try:
+        with open("/proc/meminfo", "r") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+default_build_profile = "full"
+
+
+def select_build_profile(selection, component, profiles):
+    # '*' selects profile for all components that define it
+    if selection is None:
+        return default_build_profile
+    if component in selection:
+        return selection[component]
+    profile = selection.get("*", default_build_profile)
+    if profile not in profiles:
+        return default_build_profile
+    return profile
+
+
+def get_build_key(variant, build_profile, build_mode=""):
+    # Distinguishes build trees, stamps and timings of variants, profiles and
+    # modes like PGO compiler, so trees built differently are never reused
+    parts = [variant]
+    if build_profile != default_build_profile:
+        parts.append(build_profile)
+    parts.append(build_mode)
+    return "-".join([part for part in parts if len(part) != 0])
+
+
+# Sources are shared between build variants, so fetching, unpacking and
+# patching of a component must be done by one variant at a time
+sources_locks = {}
+sources_locks_guard = threading.Lock()
+sources_users = {}
+
+# Ramdisk space promised to running builds, free space reported by the system
+# doesn't include trees that are going to be built yet
+ramdisk_reservations = {}
+ramdisk_lock = threading.Lock()
+
+
+def get_sources_lock(name):
+    with sources_locks_guard:
+        if name not in sources_locks:
+            sources_locks[name] = threading.Lock()
+        return sources_locks[name]
+
+
 class RecipeBase:
+    # Estimated size in MiB of extracted sources, shared by all variants, and
+    # of build trees of a single variant, used to decide if component fits on
+    # ramdisk
+    workspace_size = 0
+    variant_size = 0
+    # make -j install is used only by recipes whose install rules are known
+    # to be safe in parallel, the others install with single job
+    parallel_install = False
+    # Paths relative to prefix that must exist after install, {target} is
+    # replaced with target triple, profiles may add more with 'installed'
+    installed_files = []
+
     def __init__(self, **kwargs):
         if "name" in kwargs:
             self.name = kwargs["name"]
@@ -49,14 +122,177 @@ class RecipeBase:
             self.sha = kwargs["sha"]
         if "output" in kwargs:
             self.output = kwargs["output"]
-            self.sources_directory = Path(self.output) / "sources"
-            self.download_directory = self.sources_directory / "download"
+            self.download_directory = Path(self.output) / "sources" / "download"
         else:
             raise RuntimeError("'output' path must be provided")
         if "skip_verification" in kwargs:
             self.skip_verification = kwargs["skip_verification"]
         else:
             self.skip_verification = False
+        if "ramdisk" in kwargs and kwargs["ramdisk"] is not None:
+            self.ramdisk = Path(kwargs["ramdisk"])
+        else:
+            self.ramdisk = None
+        if "ramdisk_reserve" in kwargs:
+            self.ramdisk_reserve = kwargs["ramdisk_reserve"]
+        else:
+            self.ramdisk_reserve = 2048
+        if "target" in kwargs and kwargs["target"] is not None:
+            self.target = kwargs["target"]
+        if "flag_profile" in kwargs and kwargs["flag_profile"] is not None:
+            self.flag_profile = kwargs["flag_profile"]
+        else:
+            self.flag_profile = default_flag_profile
+        if self.flag_profile not in flag_profiles:
+            raise RuntimeError(
+                "Unknown flag profile: '{}'".format(self.flag_profile)
+            )
+        self.target_cflags = flag_profiles[self.flag_profile]
+        if "variant" in kwargs:
+            self.variant = kwargs["variant"]
+        else:
+            self.variant = ""
+        # Named sets of configure arguments and sources excluded from extraction
+        if "profiles" in kwargs:
+            self.build_profiles = kwargs["profiles"]
+        else:
+            self.build_profiles = {default_build_profile: {}}
+        if "build_profiles" in kwargs:
+            self.build_profile = select_build_profile(
+                kwargs["build_profiles"], self.name, self.build_profiles
+            )
+        else:
+            self.build_profile = default_build_profile
+        if self.build_profile not in self.build_profiles:
+            raise RuntimeError(
+                "Unknown build profile for '{}': '{}'".format(
+                    self.name, self.build_profile
+                )
+            )
+        if "build_mode" in kwargs:
+            self.build_mode = kwargs["build_mode"]
+        else:
+            self.build_mode = ""
+        self.build_key = get_build_key(
+            self.variant, self.build_profile, self.build_mode
+        )
+        # Concurrent builds share cores, so each make gets only part of them
+        if "make_jobs" in kwargs and kwargs["make_jobs"] is not None:
+            self.make_jobs = kwargs["make_jobs"]
+        else:
+            self.make_jobs = os.cpu_count() or 1
+        # Host tools are installed with install-strip targets
+        if "strip" in kwargs:
+            self.strip = kwargs["strip"]
+        else:
+            self.strip = False
+        if "compile_profile" in kwargs and kwargs["compile_profile"] is not None:
+            self.compile_profile = Path(kwargs["compile_profile"]).resolve()
+        else:
+            self.compile_profile = None
+
+        self.work_directory = self._select_work_directory()
+        self.sources_directory = self.work_directory / "sources"
+
+    def _ramdisk_directory(self):
+        # Unique per build directory, so different builds don't share trees
+        key = sha256(str(Path(self.output).resolve()).encode()).hexdigest()
+        return self.ramdisk / ("yasld-toolchain-" + key[:8]) / self.name
+
+    def _select_work_directory(self):
+        if self.ramdisk is None:
+            return Path(self.output)
+
+        if not self.ramdisk.is_dir():
+            print(" - Ramdisk not found:", self.ramdisk, ", building on disk")
+            return Path(self.output)
+
+        ramdisk_directory = self._ramdisk_directory()
+        with ramdisk_lock:
+            # Sources are shared, but every variant adds its own build trees
+            size = self.variant_size
+            reusing = ramdisk_directory.exists()
+            if not reusing:
+                size += self.workspace_size
+            required = (size + self.ramdisk_reserve) * 1024 * 1024
+            reserved = sum(ramdisk_reservations.values())
+            free_space = shutil.disk_usage(self.ramdisk).free - reserved
+            available_memory = get_available_memory()
+            if available_memory is not None:
+                available_memory -= reserved
+            if free_space < required or (
+                available_memory is not None and available_memory < required
+            ):
+                print(
+                    " - Not enough memory for '{}' on ramdisk, building on disk".format(
+                        self.name
+                    )
+                )
+                print("       Required  : {} MiB".format(required // (1024 * 1024)))
+                print("       Free space: {} MiB".format(free_space // (1024 * 1024)))
+                if available_memory is not None:
+                    print(
+                        "       Available : {} MiB".format(
+                            available_memory // (1024 * 1024)
+                        )
+                    )
+                return Path(self.output)
+
+            ramdisk_reservations[id(self)] = size * 1024 * 1024
+            ramdisk_directory.mkdir(parents=True, exist_ok=True)
+
+        if reusing:
+            print(" - Reusing ramdisk workspace:", ramdisk_directory)
+        else:
+            print(" - Using ramdisk workspace:", ramdisk_directory)
+        return ramdisk_directory
+
+    def release_ramdisk(self):
+        with ramdisk_lock:
+            ramdisk_reservations.pop(id(self), None)
+
+    def profiled_compiler(self, compiler, kind, tree="build"):
+        if self.compile_profile is None:
+            return compiler
+        profiler = Path(__file__).parent.parent / "compile_profiler.py"
+        wrapper = subprocess.list2cmdline(
+            [
+                sys.executable,
+                str(profiler.resolve()),
+                "exec",
+                "--database",
+                str(self.compile_profile),
+                "--component",
+                self.name,
+                "--variant",
+                self.build_key,
+                "--tree",
+                tree,
+                "--kind",
+                kind,
+                "--",
+            ]
+        )
+        if len(compiler) == 0:
+            return wrapper
+        return wrapper + " " + compiler
+
+    def profile_host_compilers(self, env, tree="build"):
+        if self.compile_profile is not None:
+            env["CC"] = self.profiled_compiler(env.get("CC", "gcc"), "host", tree)
+            env["CXX"] = self.profiled_compiler(env.get("CXX", "g++"), "host", tree)
+        return env
+
+    def variant_directory(self, name):
+        if len(self.build_key) == 0:
+            return name
+        return name + "-" + self.build_key
+
+    def get_profile_option(self, option):
+        return self.build_profiles[self.build_profile].get(option, [])
+
+    def is_on_ramdisk(self):
+        return self.work_directory != Path(self.output)
 
     def _calculate_hash(self, filepath):
         hash = sha256()
@@ -90,19 +326,42 @@ class RecipeBase:
 
         wget.download(str(self.source), str(self.source_file))
 
-    def _unpack_with_progress_bar(self, file, target):
+    def _is_excluded(self, path, exclude):
+        # Archives have top level directory, i.e. gcc-14.1.0/
+        parts = Path(path).parts
+        if len(parts) < 2:
+            return False
+        relative = "/".join(parts[1:])
+        for excluded in exclude:
+            if relative == excluded.rstrip("/") or relative.startswith(excluded):
+                return True
+        return False
+
+    def _unpack_with_progress_bar(self, file, target, exclude=None):
+        if exclude is None:
+            exclude = []
         if str(file).lower().endswith(".zip"):
             with zipfile.ZipFile(file) as zip:
+                members = [
+                    member
+                    for member in zip.infolist()
+                    if not self._is_excluded(member.filename, exclude)
+                ]
                 for member in tqdm(
-                    zip.infolist()
+                    members
                 ):
                     if not os.path.exists(Path(target) / member.filename):
                         zip.extract(member=member, path=target)
 
         else:
             with tarfile.open(name=file) as tar:
+                members = [
+                    member
+                    for member in tar.getmembers()
+                    if not self._is_excluded(member.path, exclude)
+                ]
                 for member in tqdm(
-                    iterable=tar.getmembers(), total=len(tar.getmembers())
+                    iterable=members, total=len(members)
                 ):
                     if not os.path.exists(Path(target) / member.path):
                         tar.extract(member=member, path=target)
@@ -120,7 +379,9 @@ class RecipeBase:
                 sys.exit(-1)
 
         self._unpack_with_progress_bar(
-            self.source_file, self.sources_directory / self.name
+            self.source_file,
+            self.sources_directory / self.name,
+            self.get_profile_option("exclude"),
         )
 
     def configure(self):
@@ -135,12 +396,38 @@ class RecipeBase:
     def patch(self):
         pass 
 
+    def make_install(self, directory, target=None, env=None, jobs=None):
+        if target is None:
+            target = "install-strip" if self.strip else "install"
+        if jobs is None:
+            jobs = self.make_jobs if self.parallel_install else 1
+        command = "make -j{jobs} {target}".format(jobs=jobs, target=target)
+        print(" - Install '{}' with: {} (cwd = {})".format(self.name, command, directory))
+        result = subprocess.run(command, shell=True, cwd=directory, env=env)
+        assert result.returncode == 0
+
+    def get_installed_files(self):
+        return [
+            path.format(target=self.target)
+            for path in self.installed_files + self.get_profile_option("installed")
+        ]
+
+    def verify_install(self):
+        missing = [
+            path
+            for path in self.get_installed_files()
+            if not os.path.lexists(Path(self.prefix) / path)
+        ]
+        for path in missing:
+            print(" - ERROR, '{}' didn't install: {}".format(self.name, path))
+        return len(missing) == 0
+
     def do_patches(self, package_directory):
         patches_directory = Path(__file__).parent.parent / "patches" / self.name
         if os.path.exists(patches_directory): 
             print(" - Checking patches inside: " + str(patches_directory))
             for filename in os.listdir(patches_directory):
-                done_flag_file = Path(self.output) / (Path(filename).stem + "_patch_done")
+                done_flag_file = self.work_directory / (Path(filename).stem + "_patch_done")
                 if not done_flag_file.exists():
                     patch_file = patches_directory / filename
                     source_directory = Path(__file__).parent.parent / package_directory
@@ -152,10 +439,45 @@ class RecipeBase:
 
                 
 
+    def cleanup(self):
+        if self.is_on_ramdisk():
+            print(" - Releasing ramdisk workspace:", self.work_directory)
+            shutil.rmtree(self.work_directory, ignore_errors=True)
+
+    def run_stage(self, stage, *steps):
+        start = time.perf_counter()
+        for step in steps:
+            step()
+        record_timing(
+            self.output,
+            self.name,
+            self.build_key,
+            stage,
+            time.perf_counter() - start,
+            self.make_jobs,
+        )
+
     def build(self):
-        self.fetch()
-        self.unpack()
-        self.patch()
-        self.configure()
-        self.compile()
-        self.install()
+        # Variants building on disk after ramdisk fallback use own tree
+        tree = str(self.work_directory)
+        try:
+            with get_sources_lock(self.name):
+                sources_users[tree] = sources_users.get(tree, 0) + 1
+                self.run_stage("fetch", self.fetch)
+                self.run_stage("extract", self.unpack, self.patch)
+            self.run_stage("configure", self.configure)
+            self.run_stage("compile", self.compile)
+            self.run_stage("install", self.install)
+            # Checked before workspace is released, so failed install can be
+            # retried without rebuilding
+            if not self.verify_install():
+                raise RuntimeError(
+                    "Installation of '{}' is incomplete".format(self.name)
+                )
+            with get_sources_lock(self.name):
+                sources_users[tree] -= 1
+                # other variants may still build from the same tree
+                if sources_users[tree] == 0:
+                    self.cleanup()
+        finally:
+            self.release_ramdisk()
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+#
+# target_flags.py
+#
+# Copyright (C) 2023 Mateusz Stadnik <matgla@live.com>
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General
+# Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+is_build_recipe = False
+
+default_target = "arm-none-eabi"
+default_flag_profile = "pic"
+
+# CFLAGS_FOR_TARGET used to build target libraries (newlib, libgcc, libstdc++)
+flag_profiles = {
+    "pic": "-g -Os -ffunction-sections -fdata-sections \
+-msingle-pic-base -mno-pic-data-is-text-relative -fPIC",
+    "pic-nodebug": "-Os -ffunction-sections -fdata-sections \
+-msingle-pic-base -mno-pic-data-is-text-relative -fPIC",
+    "pic-o2": "-g -O2 -ffunction-sections -fdata-sections \
+-msingle-pic-base -mno-pic-data-is-text-relative -fPIC",
+}
+
+
+def get_variant_name(target, flag_profile):
+    if target == default_target and flag_profile == default_flag_profile:
+        return ""
+    return "{target}-{profile}".format(target=target, profile=flag_profile)
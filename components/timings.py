@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+#
+# timings.py
+#
+# Copyright (C) 2023 Mateusz Stadnik <matgla@live.com>
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General
+# Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+is_build_recipe = False
+
+timings_filename = "timings.jsonl"
+
+stages = ["fetch", "extract", "configure", "compile", "install"]
+
+# Stages done once for sources shared by all variants
+shared_stages = ["fetch", "extract"]
+
+timings_lock = threading.Lock()
+
+
+def record_timing(
+    output_directory, component, variant, stage, duration, cpus=None
+):
+    # cpus are cores given to the job, planner scales parallel stages by it
+    entry = {
+        "component": component,
+        "variant": variant,
+        "stage": stage,
+        "duration": duration,
+        "finished": time.time(),
+        "cpus": cpus if cpus is not None else os.cpu_count(),
+    }
+    with timings_lock:
+        with open(Path(output_directory) / timings_filename, "a") as file:
+            file.write(json.dumps(entry) + "\n")
+
+
+def load_timings(output_directory):
+    path = Path(output_directory) / timings_filename
+    if not path.exists():
+        return []
+    timings = []
+    with open(path, "r") as file:
+        for line in file:
+            if len(line.strip()) != 0:
+                timings.append(json.loads(line))
+    return timings
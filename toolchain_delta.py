@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# toolchain_delta.py
+#
+# Copyright (C) 2023 Mateusz Stadnik <matgla@live.com>
+#
+# This program is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version
+# 3 of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General
+# Public License along with this program. If not, see
+# <https://www.gnu.org/licenses/>.
+#
+
+# Release packages with sha256 manifest and per file binary deltas between
+# releases, so installed toolchain can be upgraded without full download.
+
+import os
+import sys
+from pathlib import Path
+import argparse
+import json
+import shutil
+import tarfile
+import tempfile
+from hashlib import sha256
+
+manifest_filename = "yasld-toolchain.manifest.json"
+delta_filename = "delta.json"
+archive_root = "yasld-toolchain"
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(__file__),
+        description="Package Yasld Toolchain and upgrade it with binary deltas",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    package_parser = subparsers.add_parser(
+        "package", help="Create release archive with manifest"
+    )
+    package_parser.add_argument("--prefix", required=True)
+    package_parser.add_argument("--version", required=True)
+    package_parser.add_argument("--output-dir", default=".")
+
+    diff_parser = subparsers.add_parser(
+        "diff", help="Create delta between two releases"
+    )
+    diff_parser.add_argument(
+        "--old", required=True, help="Previous release archive or prefix"
+    )
+    diff_parser.add_argument(
+        "--new", required=True, help="New release archive or prefix"
+    )
+    diff_parser.add_argument("--output", required=True)
+
+    apply_parser = subparsers.add_parser(
+        "apply", help="Upgrade installed toolchain in place"
+    )
+    apply_parser.add_argument("--prefix", required=True)
+    apply_parser.add_argument("delta")
+
+    verify_parser = subparsers.add_parser(
+        "verify", help="Verify installed toolchain against its manifest"
+    )
+    verify_parser.add_argument("--prefix", required=True)
+
+    return parser.parse_args()
+
+
+def calculate_hash(filepath):
+    hash = sha256()
+    with open(filepath, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            hash.update(chunk)
+    return hash.hexdigest()
+
+
+def create_manifest(prefix, version):
+    files = {}
+    for path, _, filenames in os.walk(prefix):
+        for filename in filenames:
+            filepath = Path(path) / filename
+            relative = filepath.relative_to(prefix).as_posix()
+            if relative == manifest_filename:
+                continue
+            if filepath.is_symlink():
+                files[relative] = {"link": os.readlink(filepath)}
+            else:
+                files[relative] = {
+                    "sha256": calculate_hash(filepath),
+                    "mode": filepath.stat().st_mode & 0o7777,
+                }
+    return {"version": version, "files": files}
+
+
+def read_manifest(prefix):
+    with open(Path(prefix) / manifest_filename, "r") as file:
+        return json.load(file)
+
+
+def write_manifest(prefix, manifest):
+    with open(Path(prefix) / manifest_filename, "w") as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+
+
+def package(prefix, version, output_directory, name="yasld-toolchain"):
+    print(" - Creating manifest for:", prefix)
+    write_manifest(prefix, create_manifest(prefix, version))
+
+    archive = Path(output_directory) / "{}-{}.tar.xz".format(name, version)
+    Path(output_directory).mkdir(parents=True, exist_ok=True)
+    print(" - Packaging:", archive)
+    with tarfile.open(archive, "w:xz") as tar:
+        tar.add(prefix, arcname=archive_root)
+    return archive
+
+
+def open_release(path, directory):
+    # Release may be given as archive or as already extracted prefix
+    if Path(path).is_dir():
+        return Path(path)
+    with tarfile.open(path) as tar:
+        tar.extractall(directory, filter="data")
+    return Path(directory) / archive_root
+
+
+def create_delta(old_prefix, new_prefix, output):
+    # Only diff and apply need bsdiff4, packaging and verify work without it
+    import bsdiff4
+
+    old_manifest = read_manifest(old_prefix)
+    new_manifest = read_manifest(new_prefix)
+    old_files = old_manifest["files"]
+    new_files = new_manifest["files"]
+
+    entries = []
+    with tempfile.TemporaryDirectory() as directory:
+        payload = Path(directory)
+        for relative, entry in sorted(new_files.items()):
+            old_entry = old_files.get(relative)
+            if old_entry == entry:
+                continue
+
+            if "link" in entry or old_entry is None or "link" in old_entry:
+                action = "add"
+            else:
+                action = "patch"
+
+            if action == "patch":
+                with open(Path(old_prefix) / relative, "rb") as file:
+                    old_data = file.read()
+                with open(Path(new_prefix) / relative, "rb") as file:
+                    new_data = file.read()
+                if old_entry["sha256"] == entry["sha256"]:
+                    action = "mode"
+                else:
+                    patch = bsdiff4.diff(old_data, new_data)
+                    # Not worth patching completely rewritten files
+                    if len(patch) >= len(new_data):
+                        action = "add"
+                    else:
+                        patch_file = (
+                            payload / "patches" / (relative + ".bsdiff")
+                        )
+                        patch_file.parent.mkdir(parents=True, exist_ok=True)
+                        patch_file.write_bytes(patch)
+
+            if action == "add" and "link" not in entry:
+                target = payload / "files" / relative
+                target.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(Path(new_prefix) / relative, target)
+
+            delta_entry = {"path": relative, "action": action}
+            delta_entry.update(entry)
+            if action in ("patch", "mode"):
+                delta_entry["old_sha256"] = old_entry["sha256"]
+            entries.append(delta_entry)
+
+        for relative in sorted(old_files.keys()):
+            if relative not in new_files:
+                entries.append({"path": relative, "action": "remove"})
+
+        delta = {
+            "from": old_manifest["version"],
+            "to": new_manifest["version"],
+            "entries": entries,
+        }
+        with open(payload / delta_filename, "w") as file:
+            json.dump(delta, file, indent=1)
+        with open(payload / manifest_filename, "w") as file:
+            json.dump(new_manifest, file, indent=1, sort_keys=True)
+
+        with tarfile.open(output, "w:xz") as tar:
+            for name in os.listdir(payload):
+                tar.add(payload / name, arcname=name)
+
+    changed = len([e for e in entries if e["action"] != "remove"])
+    print(
+        " - Delta {} -> {}: {} changed, {} removed, {} bytes".format(
+            delta["from"],
+            delta["to"],
+            changed,
+            len(entries) - changed,
+            os.path.getsize(output),
+        )
+    )
+    return output
+
+
+def get_prefix_path(prefix, relative):
+    # Delta comes from outside, so entries must not escape the prefix, also
+    # through symlinked directories
+    root = Path(prefix).resolve()
+    path = root / relative
+    if (
+        Path(relative).is_absolute()
+        or path.name in ("", ".", "..")
+        or not path.parent.resolve().is_relative_to(root)
+    ):
+        raise RuntimeError("Delta entry outside of prefix: " + relative)
+    return path
+
+
+def verify(prefix, manifest=None):
+    if manifest is None:
+        manifest = read_manifest(prefix)
+    errors = []
+    for relative, entry in sorted(manifest["files"].items()):
+        filepath = Path(prefix) / relative
+        if "link" in entry:
+            if (
+                not filepath.is_symlink()
+                or os.readlink(filepath) != entry["link"]
+            ):
+                errors.append(relative + ": link mismatch")
+        elif not filepath.is_file():
+            errors.append(relative + ": missing")
+        elif calculate_hash(filepath) != entry["sha256"]:
+            errors.append(relative + ": sha256 mismatch")
+    return errors
+
+
+def apply_delta(prefix, delta_path):
+    import bsdiff4
+
+    prefix = Path(prefix)
+    current = read_manifest(prefix)
+
+    with tempfile.TemporaryDirectory() as directory:
+        payload = Path(directory)
+        with tarfile.open(delta_path) as tar:
+            tar.extractall(payload, filter="data")
+        with open(payload / delta_filename, "r") as file:
+            delta = json.load(file)
+        with open(payload / manifest_filename, "r") as file:
+            new_manifest = json.load(file)
+
+        if current["version"] != delta["from"]:
+            print(
+                " - Delta is for version {}, installed is {}".format(
+                    delta["from"], current["version"]
+                )
+            )
+            return False
+
+        # Check before touching anything, so failed upgrade leaves prefix intact
+        try:
+            paths = {
+                entry["path"]: get_prefix_path(prefix, entry["path"])
+                for entry in delta["entries"]
+            }
+        except RuntimeError as error:
+            print(" -", error)
+            return False
+
+        for entry in delta["entries"]:
+            if entry["action"] in ("patch", "mode"):
+                filepath = paths[entry["path"]]
+                if (
+                    not filepath.is_file()
+                    or calculate_hash(filepath) != entry["old_sha256"]
+                ):
+                    print(
+                        " - Installed file differs from release:", entry["path"]
+                    )
+                    return False
+
+        # New files are prepared next to originals and renamed into place
+        staged = []
+        for entry in delta["entries"]:
+            filepath = paths[entry["path"]]
+            staging = filepath.with_name(filepath.name + ".delta-new")
+            if entry["action"] == "patch":
+                patch = (
+                    payload / "patches" / (entry["path"] + ".bsdiff")
+                ).read_bytes()
+                staging.write_bytes(bsdiff4.patch(filepath.read_bytes(), patch))
+            elif entry["action"] == "mode":
+                shutil.copyfile(filepath, staging)
+            elif entry["action"] == "add" and "link" not in entry:
+                staging.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(payload / "files" / entry["path"], staging)
+            else:
+                continue
+            os.chmod(staging, entry["mode"])
+            staged.append((staging, filepath))
+
+        for staging, filepath in staged:
+            os.replace(staging, filepath)
+
+        for entry in delta["entries"]:
+            filepath = paths[entry["path"]]
+            if entry["action"] == "remove":
+                if filepath.is_symlink() or filepath.exists():
+                    filepath.unlink()
+            elif "link" in entry:
+                if filepath.is_symlink() or filepath.exists():
+                    filepath.unlink()
+                filepath.parent.mkdir(parents=True, exist_ok=True)
+                os.symlink(entry["link"], filepath)
+
+    errors = verify(prefix, new_manifest)
+    for error in errors:
+        print(" - Verification failed:", error)
+    if len(errors) != 0:
+        return False
+
+    # Prefix claims new version only when it really matches it
+    write_manifest(prefix, new_manifest)
+    print(" - Upgraded {} to {}".format(prefix, new_manifest["version"]))
+    return True
+
+
+def main():
+    args = parse_arguments()
+    if args.command == "package":
+        package(args.prefix, args.version, args.output_dir)
+    elif args.command == "diff":
+        with tempfile.TemporaryDirectory() as directory:
+            create_delta(
+                open_release(args.old, Path(directory) / "old"),
+                open_release(args.new, Path(directory) / "new"),
+                args.output,
+            )
+    elif args.command == "apply":
+        if not apply_delta(args.prefix, args.delta):
+            sys.exit(1)
+    elif args.command == "verify":
+        errors = verify(args.prefix)
+        for error in errors:
+            print(" - Verification failed:", error)
+        if len(errors) != 0:
+            sys.exit(1)
+        print(" - Toolchain matches manifest")
+
+
+if __name__ == "__main__":
+    main()